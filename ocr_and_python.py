@@ -13,7 +13,7 @@ Introduction in OCR:
 *OCR* systems make use of a combination of sophisticated algorithms, pattern recognition and machine learning techniques to recognize characters and words within a two-dimensinal text. These algorithm analyse the shapes and sizes to identify and interpret the text accurately. This technology can increase it accuracy and efficiency by imporve the neural networks, computer vision and deep learning on the machine.
 """
 
-! pip install easyocr torch
+# ! pip install easyocr torch
 
 """First we need to install some libraries that we will be using. For that we need to use `pip`.
 
@@ -24,9 +24,11 @@ PyTorch (`torch`) is an open-source machine learning library used for applicatio
 """
 
 import os
+import sys
 from typing import List
 import argparse
-import easyocr
+
+RUNNING_IN_NOTEBOOK = "ipykernel" in sys.modules
 
 """`import os` allows your script to interact with the operating system. It's used for tasks like navigating file directories or working with file paths.
 
@@ -34,33 +36,668 @@ import easyocr
 
 `import argparse` is used for creating user-friendly command-line interfaces. It helps your script understand command-line arguments and options, making it easier to configure and run your script from the terminal.
 
-`import easyocr` is a python package that allows computer vision developers to effortlessly perform *Optical Character Recognition*. A varied dataset of text images is fundamental for getting started with *EasyOCR*. It helps the *OCR* system to handle a wide range of text styles, fonts, and orientations, enhancing the systems overall effectiveness.
+`import sys` gives access to things about the running Python interpreter. Here it is used to check whether the code runs inside a notebook: `RUNNING_IN_NOTEBOOK` is `True` when the `ipykernel` module (the kernel behind *Jupyter* and *Google Colab*) is loaded. The example cells of this notebook only run when it is `True`, so importing this file as a module, or running it from the terminal, doesn't scan the example images or analyse their text.
+
+`easyocr` is a python package that allows computer vision developers to effortlessly perform *Optical Character Recognition*. A varied dataset of text images is fundamental for getting started with *EasyOCR*. It helps the *OCR* system to handle a wide range of text styles, fonts, and orientations, enhancing the systems overall effectiveness. It is not imported here, because importing it also loads *PyTorch*, which takes several seconds and hundreds of MB of memory. It is imported the first time a reader is needed instead.
 """
 
 # Setup reader ocr
 
-reader = easyocr.Reader(['en'])
+import threading
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+def get_reader(lang_list: list[str] = ['en'], **options):
+    key = (tuple(lang_list), tuple(sorted(options.items())))
+    with _readers_lock:
+        if key not in _readers:
+            import easyocr #Only imported now, because it loads torch and the model weights
+            _readers[key] = easyocr.Reader(list(lang_list), **options)
+        return _readers[key]
 
-"""The single line: `reader = easyocr.Reader(['en'])` initializes an *Optical Character Recognition (OCR)* reader using the EasyOCR library, specifically configured to recognize English text. Here's a breakdown of what each part of the line does:
+def __getattr__(name: str):
+    # Keeps `ocr_and_python.reader` working for code that used the old module level reader
+    if name == "reader":
+        return get_reader()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+"""The function `get_reader()` returns an *Optical Character Recognition (OCR)* reader created with `easyocr.Reader(['en'])`, using the EasyOCR library, specifically configured to recognize English text. Here's a breakdown of what each part does:
 
 `easyocr.Reader` is a constructor for creating a new *OCR* reader instance using the *EasyOCR* library. The Reader object is what you use to perform *OCR* operations on images.
 
 The parameter passed to the Reader constructor is a list of language codes specifying which languages the *OCR* engine should recognize. In this case, `['en']` indicates that the reader should be able to recognize English text. *EasyOCR* supports multiple languages, and you can pass more than one language code in this list if you need to recognize text in multiple languages.
 
-We assigned reader: This is the variable name assigned to the instance of the Reader object. Once initialized, you use this reader object to call *OCR* methods to analyze images and extract text from them.
+The reader is created lazily: nothing is loaded until the first time `get_reader()` is called, which is the first time an image is read. Creating a reader loads *PyTorch* and the detection and recognition models, which takes several seconds, so every reader is kept in `_readers` and reused. There is one reader per language list and set of options, for example `get_reader(['en', 'es'])` or `get_reader(['en'], gpu=False)`. The lock makes sure two threads asking for the same reader at the same time don't both create it.
+
+Once initialized, you use this reader object to call *OCR* methods to analyze images and extract text from them. Older code that used the module level `reader` variable still works through the module `__getattr__`, which returns `get_reader()`.
 
-Overall, this line sets up an *EasyOCR* reader instance that's ready to recognize English text in images. You can then use this reader to process images by passing them to the reader's methods, such as readtext, to extract text data.
+Overall, this sets up an *EasyOCR* reader instance that's ready to recognize English text in images. You can then use this reader to process images by passing them to the reader's methods, such as readtext, to extract text data.
 """
 
+# Setup a persistent cache for the OCR results
+
+import hashlib
+import importlib.metadata
+import json
+import sqlite3
+import threading
+import time
+
+def file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def reader_fingerprint(lang_list: list[str] = ['en']) -> str:
+    # Everything that changes what readtext returns for the same image, without importing easyocr (and torch)
+    try:
+        version = importlib.metadata.version("easyocr")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    return json.dumps({
+        "easyocr": version,
+        "lang_list": sorted(lang_list), #The languages pick both the recognition model and the characters it may return
+        "image_loader": image_loader.config() if image_loader is not None else None,
+        "page_dpi": PAGE_DPI,
+    }, sort_keys=True)
+
+class OCRCache:
+    def __init__(self, path: str = os.path.join(os.path.expanduser("~"), ".cache", "ocr_and_python", "ocr_cache.sqlite3"), max_bytes: int = 2 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self._db = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # The database is only opened when the cache is first used, so creating the cache costs nothing
+        with self.lock:
+            if self._db is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, digest TEXT, result TEXT, size INTEGER, accessed REAL)")
+                db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+                db.execute("CREATE INDEX IF NOT EXISTS results_digest ON results (digest)")
+                db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)")
+                db.commit()
+                self.total_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+                self._db = db
+            return self._db
+
+    def digest(self, image_path: str) -> str:
+        # Hash the file content, but only when its size or mtime changed since we last hashed it
+        path = os.path.abspath(image_path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, digest FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        digest = file_sha256(path)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, digest))
+            self.db.commit()
+        return digest
+
+    def key(self, digest: str, config: str) -> str:
+        return hashlib.sha256(f"{digest}:{config}".encode()).hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.db.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        return [(bbox, text, confidence) for bbox, text, confidence in json.loads(row[0])]
+
+    def put(self, key: str, digest: str, result: list) -> None:
+        # Numpy coordinates and confidences are turned into plain numbers for json
+        data = json.dumps([[bbox, text, confidence] for bbox, text, confidence in result], default=lambda o: o.tolist())
+        with self.lock:
+            old = self.db.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", (key, digest, data, len(data), time.time()))
+            self.total_bytes += len(data) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.db.commit()
+
+    def _evict(self) -> None:
+        # Drop the least recently used results until we are back under 90% of max_bytes
+        while self.total_bytes > self.max_bytes * 0.9: #Not just max_bytes: a batch can end between the two
+            rows = self.db.execute("SELECT key, size FROM results ORDER BY accessed LIMIT 1000").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes * 0.9:
+                    return
+
+    def invalidate(self, image_path: str) -> None:
+        path = os.path.abspath(image_path)
+        with self.lock:
+            row = self.db.execute("SELECT digest FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None:
+                self.db.execute("DELETE FROM results WHERE digest = ?", (row[0],))
+                self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+                self.db.commit()
+                self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM results")
+            self.db.execute("DELETE FROM files")
+            self.db.commit()
+            self.total_bytes = 0
+
+ocr_cache = OCRCache()
+
+"""This code sets up a persistent, on-disk cache for the *OCR* results, so an image that has already been read never has to go through *EasyOCR* again. Here's a breakdown of how it works:
+
+**Content-Addressed Keys:**
+
+`OCRCache.digest` computes a *SHA-256* hash of the image file content. The cache key combines this digest with `reader_fingerprint(lang_list)`, which describes the *EasyOCR* version and the language list of the reader, so an `['en']` reader and an `['en', 'fr']` reader never share results. The version is read from the installed package metadata, and the reader itself is only created when an image is not in the cache, so a search where every image is already cached never loads *PyTorch* or the models. Renaming or copying an image keeps its cached results, while changing the file content or the reader configuration produces a new key.
+
+**Avoiding Re-Hashing:**
+
+The `files` table remembers the size, modification time and digest of every path that was hashed. As long as the size and modification time have not changed, the stored digest is reused, so a warm cache does not even read the image files.
+
+**Full Results:**
+
+The complete `(bbox, text, confidence)` tuples returned by `readtext` are stored as *JSON* in an *SQLite* database, so nothing that *EasyOCR* found is lost.
+
+**Size-Bounded Eviction:**
+
+Every result records when it was last accessed. When the total size of the stored results grows over `max_bytes` (2 GB by default), the least recently used results are deleted until the cache is back under 90% of that limit.
+
+The database is only opened the first time the cache is used, so creating `ocr_cache` doesn't touch the disk.
+
+**Invalidation:**
+
+`ocr_cache.invalidate(image_path)` drops the cached results of one image and `ocr_cache.clear()` empties the whole cache. Setting `ocr_cache = None` turns caching off.
+"""
+
+# Measure where the time goes: per-stage timers and counters, turned off by default
+
+import collections
+import contextlib
+
+class OCRMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages = {} #stage -> [calls, seconds, longest call]
+        self.counters = collections.Counter()
+
+    def stage(self, name: str) -> "_StageTimer":
+        return _StageTimer(self, name)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] = max(stage[2], seconds)
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += n
+
+    def snapshot(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        with self.lock:
+            stages = {name: {"calls": calls, "seconds": seconds, "mean_ms": seconds / calls * 1000, "max_ms": longest * 1000,
+                             "share": seconds / elapsed if elapsed else 0.0}
+                      for name, (calls, seconds, longest) in self.stages.items()}
+            counters = dict(self.counters)
+        images = counters.get("images", 0)
+        return {"time": time.time(), "elapsed_seconds": elapsed, "images_per_second": images / elapsed if elapsed else 0.0,
+                "crops_per_image": counters.get("crops", 0) / images if images else 0.0,
+                "peak_rss_bytes": peak_rss_bytes(), "stages": stages, "counters": counters}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started = time.perf_counter()
+            self.stages.clear()
+            self.counters.clear()
+
+    def write_jsonl(self, path: str = "ocr_metrics.jsonl") -> dict:
+        snapshot = self.snapshot()
+        with open(path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(snapshot) + "\n")
+        return snapshot
+
+    def prometheus(self) -> str:
+        # The Prometheus text format, for a /metrics endpoint
+        snapshot = self.snapshot()
+        lines = ["# TYPE ocr_stage_seconds summary"]
+        for name, stage in snapshot["stages"].items():
+            lines.append(f'ocr_stage_seconds_sum{{stage="{name}"}} {stage["seconds"]}')
+            lines.append(f'ocr_stage_seconds_count{{stage="{name}"}} {stage["calls"]}')
+        lines.append("# TYPE ocr_events_total counter")
+        lines += [f'ocr_events_total{{event="{name}"}} {count}' for name, count in snapshot["counters"].items()]
+        lines += ["# TYPE ocr_images_per_second gauge", f"ocr_images_per_second {snapshot['images_per_second']}",
+                  "# TYPE ocr_peak_rss_bytes gauge", f"ocr_peak_rss_bytes {snapshot['peak_rss_bytes']}"]
+        return "\n".join(lines) + "\n"
+
+    def report(self) -> None:
+        snapshot = self.snapshot()
+        print(f"{snapshot['elapsed_seconds']:.1f} s, {snapshot['images_per_second']:.2f} images/sec, "
+              f"{snapshot['crops_per_image']:.1f} text lines per image, peak RSS {snapshot['peak_rss_bytes'] / 2 ** 20:.0f} MB")
+        for name, stage in sorted(snapshot["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            print(f"  {name:<10} {stage['seconds']:9.2f} s {stage['share']:6.1%} {stage['calls']:>8} calls "
+                  f"{stage['mean_ms']:9.2f} ms mean {stage['max_ms']:9.2f} ms max")
+        for name, count in sorted(snapshot["counters"].items()):
+            print(f"  {name:<14} {count:>9}")
+
+class _StageTimer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: OCRMetrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+metrics = None
+_no_timer = contextlib.nullcontext()
+
+def stage_timer(name: str):
+    # `with stage_timer("decode"):` times the block when metrics are on, and costs next to nothing when they are off
+    return metrics.stage(name) if metrics is not None else _no_timer
+
+def count_event(name: str, n: int = 1) -> None:
+    if metrics is not None:
+        metrics.count(name, n)
+
+def peak_rss_bytes() -> int:
+    try:
+        import resource
+    except ImportError: #Not available on Windows
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 #Bytes on macOS, kilobytes on Linux
+
+def timed_walk(directory: str):
+    # os.walk, with the time spent listing the directories counted as the "walk" stage
+    walk = os.walk(directory)
+    while True:
+        with stage_timer("walk"):
+            entry = next(walk, None)
+        if entry is None:
+            return
+        yield entry
+
+def read_text(reader, image) -> list:
+    # reader.readtext(image), split into its decode, detect and recognize steps when metrics are on
+    if metrics is None:
+        return reader.readtext(image)
+    from easyocr.utils import reformat_input
+    with stage_timer("decode" if isinstance(image, str) else "reformat"): #An array was already decoded, and timed, by its caller
+        img, img_cv_grey = reformat_input(image)
+    with stage_timer("detect"):
+        horizontal_list, free_list = reader.detect(img, reformat=False)
+    with stage_timer("recognize"):
+        result = reader.recognize(img_cv_grey, horizontal_list[0], free_list[0], reformat=False)
+    count_event("images")
+    count_event("crops", len(result))
+    return result
+
+@contextlib.contextmanager
+def trace(path: str = "ocr_trace.prof", top: int = 25):
+    # Profiles everything in the with block with cProfile; the file can be opened with snakeviz or pstats
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+
+def compare_metrics(before: dict, after: dict, threshold: float = 0.1) -> list[str]:
+    # Compares two snapshots (for example two lines of ocr_metrics.jsonl) and returns the stages that got slower
+    slower = []
+    print(f"images/sec {before['images_per_second']:.2f} -> {after['images_per_second']:.2f}")
+    for name in sorted(set(before["stages"]) | set(after["stages"])):
+        old = before["stages"].get(name, {}).get("mean_ms")
+        new = after["stages"].get(name, {}).get("mean_ms")
+        if old is None or new is None:
+            print(f"  {name:<10} only in {'after' if old is None else 'before'}")
+            continue
+        change = new / old - 1 if old else 0.0
+        flag = "  SLOWER" if change > threshold else ""
+        print(f"  {name:<10} {old:9.2f} ms -> {new:9.2f} ms {change:+7.1%}{flag}")
+        if flag:
+            slower.append(name)
+    return slower
+
+"""This code adds optional instrumentation to the *OCR* pipeline, to see where the time goes: walking the directories, decoding the images, detecting the text, recognizing it or matching the keyword, and how many images were read, skipped or failed. Here's a breakdown of how it works:
+
+**Turning It On:**
+
+`metrics` is `None` by default, and then every timer is a shared `nullcontext` and every counter a single `if`, so the cost is too small to measure next to the *OCR*. `metrics = OCRMetrics()` turns it on (or `ocr_and_python.metrics = OCRMetrics()` when the module is imported), and `metrics = None` turns it off again.
+
+**Stages:**
+
+`with stage_timer("decode"):` adds the time of the block to a stage. The stages are:
+
+* `walk` - listing the directories (`timed_walk`, used by `search_images` and `iter_image_files`),
+* `decode` - opening and decoding the images,
+* `reformat` - turning an image that was already decoded (by the `image_loader`, the service or a PDF page) into the colour and grey arrays *EasyOCR* works on, which `read_text` counts apart so the decoding isn't counted twice,
+* `detect` and `recognize` - the two steps of *EasyOCR*. When metrics are on, `read_text` runs the same steps as `readtext` one by one, so each of them can be timed,
+* `match` - comparing the keyword with the text.
+
+For every stage, the number of calls, the total time, the mean and the longest call are kept.
+
+**Counters:**
+
+`count_event(name)` counts events: `images` read, `crops` (the text lines recognized), `cache_hits`, `skipped` images (by the pre-filter), `failed` images and `bytes_read`. `metrics.snapshot()` returns all of it as a dictionary, with the images per second, the text lines per image and the peak memory (*RSS*) of the process.
+
+**Export:**
+
+`metrics.report()` prints a table with the stages sorted by their total time. `metrics.write_jsonl("ocr_metrics.jsonl")` appends a snapshot as one *JSON* line, and `metrics.prometheus()` returns the *Prometheus* text format, which the *OCR* service serves on `GET /metrics`. `compare_metrics(before, after)` compares two snapshots, for example from two runs before and after a change, and marks every stage whose mean time grew by more than 10%. With a `BatchOCREngine`, the stages run in the worker processes and are not counted, but the images, cache hits and failures are.
+
+**Trace Mode:**
+
+`with trace("ocr_trace.prof"):` profiles everything in the block with `cProfile`, prints the functions that took the most time, and saves the profile, which can be opened with tools like *snakeviz*. For a sampling profiler, `py-spy record -o profile.svg -- python ocr_and_python.py` works as well, and the threads of the service and of the streaming search have names, so they are easy to tell apart.
+"""
+
+# Decode the images ourselves: smaller and grey
+
+import multiprocessing
+import statistics
+
+class ImageLoader:
+    def __init__(self, target_dpi: int = 300, max_side: int = 4000):
+        self.target_dpi = target_dpi
+        self.max_side = max_side
+
+    def config(self) -> dict:
+        return {"target_dpi": self.target_dpi, "max_side": self.max_side}
+
+    def scale_for(self, width: int, height: int, dpi: float) -> float:
+        scale = min(1.0, self.max_side / max(width, height))
+        if dpi and dpi > self.target_dpi: #A 600 dpi scan isn't read any better than the same scan at 300 dpi
+            scale = min(scale, self.target_dpi / dpi)
+        return scale
+
+    def load(self, image_path: str) -> tuple:
+        # Returns a 2-D grey image and the scale it was reduced by
+        import numpy as np
+        from PIL import Image
+        if metrics is not None:
+            metrics.count("bytes_read", os.path.getsize(image_path))
+        with stage_timer("decode"), Image.open(image_path) as image:
+            width, height = image.size
+            scale = self.scale_for(width, height, image.info.get("dpi", (0, 0))[0])
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            image.draft("L", size) #JPEGs are decoded straight at 1/2, 1/4 or 1/8 of their size when that's enough
+            image = image.convert("L")
+            if image.size != size:
+                image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+            pixels = np.asarray(image) #The array is made from the decoded image once, with no copy after that
+        return pixels, scale
+
+    @staticmethod
+    def rescale(result: list, scale: float) -> list:
+        # Put the bounding boxes back into the coordinates of the original image
+        if scale == 1.0:
+            return result
+        return [([[round(float(x) / scale), round(float(y) / scale)] for x, y in bbox], text, confidence)
+                for bbox, text, confidence in result]
+
+image_loader = None
+
+def read_image_text(reader, image_path: str) -> list:
+    if is_multipage(image_path): #The lines of all the pages, one page after the other
+        return [line for _, result in read_pages_text(reader, image_path) for line in result]
+    if image_loader is None:
+        return read_text(reader, image_path)
+    image, scale = image_loader.load(image_path)
+    return image_loader.rescale(read_text(reader, image), scale) #A 2-D array is used by EasyOCR as it is, without copying
+
+def _benchmark_loading_child(image_paths: list[str], loader: ImageLoader, connection) -> None:
+    import resource
+    global image_loader
+    image_loader = loader
+    reader = get_reader()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = []
+    for image_path in image_paths:
+        start = time.perf_counter()
+        read_image_text(reader, image_path)
+        latencies.append(time.perf_counter() - start)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    connection.send((latencies, rss_before, rss_after))
+
+def benchmark_image_loading(image_paths: list[str], loader: ImageLoader = None) -> dict:
+    # Reads the same images from file paths and through the loader, each in a fresh process, to compare peak memory
+    report = {}
+    for name, variant in [("readtext(path)", None), ("ImageLoader", loader or ImageLoader())]:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_benchmark_loading_child, args=(image_paths, variant, sender))
+        process.start()
+        latencies, rss_before, rss_after = receiver.recv()
+        process.join()
+        unit = 1024 * 1024 if sys.platform == "darwin" else 1024 #ru_maxrss is in bytes on macOS, in KB on Linux
+        report[name] = {"median_seconds": statistics.median(latencies), "mean_seconds": statistics.mean(latencies),
+                        "peak_rss_mb": rss_after / unit, "peak_rss_growth_mb": (rss_after - rss_before) / unit}
+        print(f"{name:<16} median {report[name]['median_seconds']:.3f} s/image, mean {report[name]['mean_seconds']:.3f} s/image, "
+              f"peak RSS {report[name]['peak_rss_mb']:.0f} MB (+{report[name]['peak_rss_growth_mb']:.0f} MB while reading)")
+
+    return report
+
+"""This code adds an image loading stage in front of the *OCR*. Given a path, `readtext` decodes the image twice (once in colour and once in grey) at whatever resolution it was stored, so a scan at 600 dpi uses four times the memory and detection time of the same scan at 300 dpi, without being read any better. Here's a breakdown of how the loader works:
+
+**Reducing the Resolution:**
+
+`ImageLoader.load` opens the image with *Pillow* and works out how much it should be reduced: its longest side is capped at `max_side` pixels, and when the file says it was scanned at more than `target_dpi` dots per inch, it is reduced to `target_dpi`. For *JPEG* files, `image.draft` makes *Pillow* decode the image directly at a half, a quarter or an eighth of its size (*DCT scaling*), which is much faster and lighter than decoding it fully and shrinking it afterwards. The image is converted to grey once, and resized to the exact size if needed.
+
+**One Array per Image:**
+
+The grey image is turned into a *NumPy* array with `np.asarray`, which is the only copy of the pixels made after decoding. *Pillow* always decodes into memory of its own, so copying its pixels into a reused buffer would only add another copy. The loader only holds its settings, so it can be sent to another process, for example by `benchmark_image_loading` or to the workers of a `BatchOCREngine`.
+
+**Handing the Image to the Reader:**
+
+`read_image_text` passes the grey array to `readtext`. *EasyOCR* uses a 2-D array directly as its grey image, without copying or decoding it again. As the image may have been reduced, `rescale` puts the bounding boxes back into the coordinates of the original image.
+
+**Turning It On:**
+
+The loader is off by default. Setting `image_loader = ImageLoader(target_dpi=300)` makes `ocr_scan`, `search_images` and the other functions read images through it. The loader settings are part of `reader_fingerprint`, so results read with and without it are cached separately.
+
+**Benchmark:**
+
+`benchmark_image_loading(image_paths)` reads the same images with `readtext(path)` and with the loader, each in a new process, and prints the time per image and the peak memory use (*RSS*) of both.
+"""
+
+# ! pip install pypdfium2
+
+# Read multi-page TIFF files and scanned PDFs page by page
+
+import itertools
+
+MULTIPAGE_EXTENSIONS = (".tif", ".tiff", ".pdf")
+PAGE_DPI = 300 #PDF pages are rendered at this resolution, or at the target_dpi of the image_loader
+
+def is_multipage(image_path: str) -> bool:
+    return image_path.lower().endswith(MULTIPAGE_EXTENSIONS)
+
+def _open_pdf(path: str):
+    try:
+        import pypdfium2
+    except ImportError:
+        raise ImportError("reading PDF files needs pypdfium2 (pip install pypdfium2)") from None
+    return pypdfium2.PdfDocument(path)
+
+def count_pages(path: str) -> int:
+    if path.lower().endswith(".pdf"):
+        pdf = _open_pdf(path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    from PIL import Image
+    with Image.open(path) as image:
+        return getattr(image, "n_frames", 1)
+
+def iter_pages(path: str, pages: list[int] = None):
+    # Yields (page, grey image, scale) one page at a time, rendering each page only when it is asked for
+    import numpy as np
+    if path.lower().endswith(".pdf"):
+        dpi = image_loader.target_dpi if image_loader is not None else PAGE_DPI
+        pdf = _open_pdf(path)
+        try:
+            for page in pages if pages is not None else range(len(pdf)):
+                bitmap = pdf[page].render(scale=dpi / 72, grayscale=True) #PDF sizes are in points, 72 to the inch
+                yield page, np.array(bitmap.to_pil().convert("L")), 1.0
+        finally:
+            pdf.close()
+        return
+    from PIL import Image
+    with Image.open(path) as image:
+        for page in pages if pages is not None else range(getattr(image, "n_frames", 1)):
+            image.seek(page)
+            frame = image.convert("L")
+            scale = 1.0
+            if image_loader is not None:
+                scale = image_loader.scale_for(frame.width, frame.height, image.info.get("dpi", (0, 0))[0])
+                if scale < 1.0:
+                    frame = frame.resize((max(1, round(frame.width * scale)), max(1, round(frame.height * scale))), Image.BILINEAR)
+            yield page, np.asarray(frame), scale
+
+def read_page_text(reader, path: str, page: int) -> list:
+    for _, image, scale in iter_pages(path, [page]):
+        return ImageLoader.rescale(read_text(reader, image), scale)
+
+def read_pages_text(reader, path: str) -> list:
+    return [(page, ImageLoader.rescale(read_text(reader, image), scale)) for page, image, scale in iter_pages(path)]
+
+def ocr_scan_page_results(path: str, page: int, lang_list: list[str] = ['en']) -> list:
+    if ocr_cache is None:
+        return read_page_text(get_reader(lang_list), path, page)
+    digest = ocr_cache.digest(path)
+    key = ocr_cache.key(digest, f"{reader_fingerprint(lang_list)}#page={page}")
+    result = ocr_cache.get(key)
+    if result is None:
+        result = read_page_text(get_reader(lang_list), path, page)
+        ocr_cache.put(key, digest, result)
+
+    return result
+
+def ocr_scan_pages(path: str, engine: "BatchOCREngine" = None) -> list:
+    # [(page, results)] for every page of the file; with an engine the pages are read in parallel
+    if not is_multipage(path):
+        return [(0, ocr_scan_results(path))]
+    pages = range(count_pages(path))
+    if engine is not None:
+        return [(source[1], result) for source, result, error in engine.scan((path, page) for page in pages) if error is None]
+    return [(page, ocr_scan_page_results(path, page)) for page in pages]
+
+def expand_pages(image_paths, ready: list = None, page_counts: dict = None):
+    # The image paths, with every multi-page file replaced by its pages as (path, page) pairs;
+    #the files that have no page to read go to ready as (path, result, error), and the number of pages to page_counts
+    for image_path in image_paths:
+        if not is_multipage(image_path):
+            yield image_path
+            continue
+        try:
+            pages = count_pages(image_path)
+        except Exception as error: #A file that can't be opened has no pages to read, but the caller should know
+            if ready is not None:
+                ready.append((image_path, None, f"{type(error).__name__}: {error}"))
+            continue
+        if page_counts is not None:
+            page_counts[image_path] = pages
+        if not pages and ready is not None:
+            ready.append((image_path, [], None))
+        for page in range(pages):
+            yield image_path, page
+
+def iter_page_sources(directory: str, errors: list = None):
+    # Every image below directory, and every page of the multi-page files as a (path, page) pair
+    return expand_pages(iter_image_files(directory), errors)
+
+def _read_source(source) -> tuple:
+    try:
+        return source, ocr_scan_page_results(*source) if isinstance(source, tuple) else ocr_scan_results(source), None
+    except Exception as error:
+        return source, None, f"{type(error).__name__}: {error}"
+
+def scan_page_sources(directory: str, engine: "BatchOCREngine" = None):
+    # Yields (source, result, error) for every image and page below directory, like BatchOCREngine.scan does;
+    # multi-page files that can't be opened come out as (path, None, error)
+    errors = []
+    sources = iter_page_sources(directory, errors)
+    results = engine.scan(sources) if engine is not None else map(_read_source, sources)
+    for item in itertools.chain(results, [None]):
+        yield from errors
+        errors.clear()
+        if item is not None:
+            yield item
+
+def search_pages(directory: str, keyword: str, engine: "BatchOCREngine" = None):
+    # Yields (file, page, bbox, text) for every text line with the keyword; single images are page 0
+    for source, result, error in scan_page_sources(directory, engine):
+        if error is not None:
+            count_event("failed")
+            continue
+        path, page = source if isinstance(source, tuple) else (source, 0)
+        for bbox, text, _ in result:
+            if keyword.lower() in text.lower():
+                yield path, page, bbox, text
+
+"""This code adds support for multi-page *TIFF* files (like faxes) and scanned *PDF* files, without having to convert them into separate images first. *PDF* pages are rendered with the `pypdfium2` library, which needs to be installed with the `pip` command above. *TIFF* files are read with *Pillow*. Here's a breakdown of how it works:
+
+**Pages on Demand:**
+
+`iter_pages(path)` is a generator that renders one page at a time, only when it is asked for, and yields `(page, image, scale)`. The next page is not rendered until the caller has finished with the previous one, so even a file with hundreds of pages only holds one page in memory. *PDF* pages are rendered in grey at `PAGE_DPI` dots per inch (or at the `target_dpi` of the `image_loader`), and *TIFF* pages are reduced like the `image_loader` reduces images, when it is turned on.
+
+**Reading Pages:**
+
+`ocr_scan_page_results(path, page)` reads a single page, through `ocr_cache` like `ocr_scan_results` does, with the page number as part of the cache key. `ocr_scan_results` reads a multi-page file by joining the results of its pages, so a page is only read once, whether it was asked for on its own or as part of the whole file. `ocr_scan_pages(path)` returns a list of `(page, results)` for every page. When given a `BatchOCREngine`, the pages are sent to its worker processes as `(path, page)` pairs, and every worker renders and reads its own pages, so the pages of a long document are read in parallel.
+
+**Searching Pages:**
+
+`search_images` and `ocr_scan` now also accept `.tif`, `.tiff` and `.pdf` files, and join the text of all the pages. To know where the keyword was found, `search_pages(directory, keyword)` yields `(file, page, bbox, text)` for every text line that contains the keyword, so every hit points at the right page. Single images are reported as page 0. With an `engine`, the pages of all the files are spread over the worker processes. Both use `scan_page_sources(directory)`, which yields `(source, result, error)` like a `BatchOCREngine` does: a *PDF* or *TIFF* file that can't be opened, or an image that can't be read, comes out with an error message instead of being dropped, and is counted as `failed`.
+"""
+
+def ocr_scan_results(image_path: str, lang_list: list[str] = ['en']) -> list:
+    if is_multipage(image_path): #Page by page, so every page is read and cached once, whichever function asks for it
+        return [line for page in range(count_pages(image_path)) for line in ocr_scan_page_results(image_path, page, lang_list)]
+    if ocr_cache is None:
+        return read_image_text(get_reader(lang_list), image_path)
+    digest = ocr_cache.digest(image_path)
+    key = ocr_cache.key(digest, reader_fingerprint(lang_list))
+    result = ocr_cache.get(key) #Look for the results of this image in the cache first
+    count_event("cache_hits" if result is not None else "cache_misses")
+    if result is None:
+        result = read_image_text(get_reader(lang_list), image_path) #Only now is the reader (and its models) loaded
+        ocr_cache.put(key, digest, result)
+
+    return result
+
 def ocr_scan(image_path: str) -> str:
-    result = reader.readtext(image_path) #Use the reader to read text from the image
+    result = ocr_scan_results(image_path) #Read the text from the image, or take it from the cache
     recognized_text = " ".join([text for _, text, _ in result]) #Combine the detected text pieces into a single string
 
     return recognized_text
 
-image_path = "/content/Test_image.png"
-recognized_text = ocr_scan(image_path)
-print(recognized_text)
+if RUNNING_IN_NOTEBOOK:
+    image_path = "/content/Test_image.png"
+    recognized_text = ocr_scan(image_path)
+    print(recognized_text)
 
 """This code defines a Python function named `ocr_scan` that performs *Optical Character Recognition (OCR)* on an image file to extract and return its textual content as a single string. Here's a step-by-step explanation:
 
@@ -70,7 +707,7 @@ The function `ocr_scan` is defined with one parameter, `image_path`, which is a
 
 **Performing OCR:**
 
-`result = reader.readtext(image_path)` uses an *OCR* reader to perform OCR on the image located at `image_path`. The readtext method of the reader object processes the image and returns a list of tuples. Each tuple contains the bounding box coordinates of a detected text region, the text string itself, and a confidence level for the OCR recognition.
+`result = ocr_scan_results(image_path)` uses an *OCR* reader to perform OCR on the image located at `image_path`. The readtext method of the reader object processes the image and returns a list of tuples. Each tuple contains the bounding box coordinates of a detected text region, the text string itself, and a confidence level for the OCR recognition. `ocr_scan_results` first looks the image up in `ocr_cache`, and only calls `reader.readtext(image_path)` (through `read_image_text`, which uses the `image_loader` when it is turned on) when the image has not been read before; the new results are then stored in the cache.
 
 **Extracting and Combining Recognized Text:**
 
@@ -81,25 +718,45 @@ The function `ocr_scan` is defined with one parameter, `image_path`, which is a
 `return recognized_text` returns the combined recognized text as its output.
 """
 
-def search_images(directory: str, keyword: str) -> list[str]:
+def keyword_in_result(keyword: str, result: list, max_distance: int = 0) -> bool:
+    # The keyword anywhere in the text of the image, or within max_distance of one of its lines
+    detected_text = " ".join([text for _, text, _ in result])
+    return keyword.lower() in detected_text.lower() or bool(max_distance and fuzzy_find(keyword, result, max_distance))
+
+def search_images(directory: str, keyword: str, engine: "BatchOCREngine" = None, prefilter: "TextPrefilter" = None,
+                  max_distance: int = 0) -> list[str]:
     matching_images = []
-    for root, dir, files in os.walk(directory):
-        for file in files:
-            if file.endswith((".png", ".jpg", ".jpeg")):
-                image_path = os.path.join(root, file)
-                detected_text = ocr_scan(image_path)
-                if keyword.lower() in detected_text.lower():
+    if engine is not None: #Let the pool of worker processes do the OCR
+        image_paths = iter_image_files(directory)
+        if prefilter is not None: #Skip images that don't look like they contain text before they reach the workers
+            image_paths = prefiltered(image_paths, prefilter)
+        for image_path, result, error in engine.scan_files(image_paths):
+            with stage_timer("match"):
+                if error is None and keyword_in_result(keyword, result, max_distance):
                     matching_images.append(image_path)
+        return matching_images
+    for root, dir, files in timed_walk(directory): #os.walk, timed when metrics are on
+        for file in files:
+            if file.lower().endswith((".png", ".jpg", ".jpeg", ".tif", ".tiff", ".pdf")):
+                image_path = os.path.abspath(os.path.join(root, file)) #The same paths as with an engine
+                if prefilter is not None and not prefilter(image_path): #Skip images that don't look like they contain text
+                    count_event("skipped")
+                    continue
+                result = ocr_scan_results(image_path) #Read the text from the image, or take it from the cache
+                with stage_timer("match"):
+                    if keyword_in_result(keyword, result, max_distance): #With max_distance, allow a few OCR mistakes
+                        matching_images.append(image_path)
 
     return matching_images
 
-search_images(".", keyword = "wisdom")
+if RUNNING_IN_NOTEBOOK:
+    print(search_images(".", keyword = "wisdom"))
 
 """This code defines a function named `search_images` that is designed to search for images containing a specified keyword using *OCR*. Here's a step by step explanation:
 
 **Function Definition:**
 
-The function is named `search_images`, and takes two parameters. The first is `directory`, which is a string representing the directory path where the images are stored. The second parameter is `keyword`, which is a string representing the keyword to search for in the text detected in the images. The return type is specified as a list of strings `list[str]`, representing the paths of the matching images.
+The function is named `search_images`, and takes two parameters. The first is `directory`, which is a string representing the directory path where the images are stored. The second parameter is `keyword`, which is a string representing the keyword to search for in the text detected in the images. The return type is specified as a list of strings `list[str]`, representing the paths of the matching images. The optional `engine` parameter takes a `BatchOCREngine` (defined further down), which reads the images of the directory with a pool of worker processes instead of one at a time. The optional `prefilter` parameter takes a `TextPrefilter` (also defined further down), which skips images that don't look like they contain any text before reading them. With `max_distance` set to 1 or more, images where the keyword was misread by the *OCR* are also found, as explained in the fuzzy matching section further down.
 
 **Initialization of an Empty List:**
 
@@ -107,19 +764,19 @@ The code `matching_images = []` initializes an empty list. This list will be use
 
 **Iterating Through Files in the Specified Directory:**
 
-The `os.walk` function is used to iterate through all the files in the specified directory and its subdirectories. `root` represents the current directory being processed, `dir` represents the subdirectories in the current directory, and `files` represents the files in the current directory. All of these variables are used inside a for loop.
+The `os.walk` function is used to iterate through all the files in the specified directory and its subdirectories (through `timed_walk`, which is `os.walk` with a timer for the instrumentation described further down). `root` represents the current directory being processed, `dir` represents the subdirectories in the current directory, and `files` represents the files in the current directory. All of these variables are used inside a for loop.
 
 **Filtering Image Files:**
 
-This part of the code uses a for loop to check, for each file in the current directory, if the file has one of the specified image extensions, for example, `(".png", ".jpg", ".jpeg")`. This is a basic filter to exclude all non-image files that cannot be detected by OCR.
+This part of the code uses a for loop to check, for each file in the current directory, if the file has one of the specified image extensions, for example, `(".png", ".jpg", ".jpeg")`, or is a multi-page `.tif`, `.tiff` or `.pdf` file. This is a basic filter to exclude all non-image files that cannot be detected by OCR.
 
 **Extracting Image Paath and Performing OCR:**
 
-In the code `image_path = os.path.join(root, file)`, the full path of the image file is created using os.path.join. The function `ocr_scan`, which had been defined before, is called with the image path, which presumably performs OCR on the image, extracting the text from it.
+In the code `image_path = os.path.abspath(os.path.join(root, file))`, the full path of the image file is created using os.path.join, and made absolute, so the paths returned are the same whether or not an `engine` is used. The function `ocr_scan_results`, which had been defined before, is called with the image path, which performs OCR on the image (or takes the result from the cache), extracting the lines of text from it.
 
 **Checking for Jeyword in Detected Text:**
 
-This part discusses the code: `if keyword.lower() in detected_text.lower():`. Both the keyword and detected text are converted to lowercase using the function `.lower()`. As part of the code is an if statement, it checks if the lowercase keyword is present in the lowercase detected text. If the keyword is found in the detected text, the image path is considered a match.
+This part discusses the function `keyword_in_result`, used with and without an `engine`. It joins the lines of text into `detected_text`, and checks `keyword.lower() in detected_text.lower()`. Both the keyword and detected text are converted to lowercase using the function `.lower()`, and it checks if the lowercase keyword is present in the lowercase detected text. If the keyword is found in the detected text, the image path is considered a match. With `max_distance` set, a line of text that is within `max_distance` mistakes of the keyword (`fuzzy_find`) is a match as well.
 
 **Appending Matching Image Paths to List:**
 
@@ -134,23 +791,1940 @@ The return code looks like this: `return matching_images`. Therefore, after proc
 `search_images(".", keyword="wisdom")` calls the fuctionand looks in the current directory `(".")` and the keyword "wisdom" in this case. It returns a list of paths from the images where the detected keyword is found.
 """
 
+# Build a persistent inverted index over the OCR results, so keyword searches don't need to OCR again
+
+import re
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".pdf")
+
+def iter_image_files(directory: str):
+    for root, dir, files in timed_walk(directory):
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.abspath(os.path.join(root, file))
+
+FUZZY_MAX_JOIN = 3 #How many words in a row FuzzyIndex also compares joined together
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+def keyword_query(keyword: str) -> str:
+    # A plain keyword becomes a phrase whose last word is a prefix, so "wis" finds "wisdom" like the old substring check
+    if '"' in keyword or "*" in keyword or re.search(r"\sOR\s", keyword) or not tokenize(keyword):
+        return keyword #Already written in the query syntax
+    return '"' + " ".join(tokenize(keyword)) + '*"'
+
+class OCRIndex:
+    def __init__(self, path: str = os.path.join(os.path.expanduser("~"), ".cache", "ocr_and_python", "ocr_index.sqlite3")):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime_ns INTEGER, digest TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS postings (term TEXT, doc INTEGER, position INTEGER, bbox TEXT, confidence REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS postings_term ON postings (term, doc, position)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)")
+        # The vocabulary of FuzzyIndex, kept up to date with the postings so it is never rebuilt for a search
+        self.db.execute("CREATE TABLE IF NOT EXISTS vocabulary (key TEXT, sequence TEXT, doc INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS vocabulary_key ON vocabulary (key)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS vocabulary_doc ON vocabulary (doc)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS bktree (key TEXT PRIMARY KEY, parent TEXT, distance INTEGER) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS bktree_children ON bktree (parent, distance)")
+        self.db.commit()
+        self.errors = {} #image path -> why it could not be read, for the images of the last updates
+
+    def documents(self, directory: str = None) -> dict:
+        # path -> (id, size, mtime_ns, digest) of every indexed image, optionally only those below directory
+        with self.lock:
+            rows = self.db.execute("SELECT path, id, size, mtime_ns, digest FROM documents").fetchall()
+        prefix = os.path.join(os.path.abspath(directory), "") if directory is not None else ""
+        return {path: tuple(row) for path, *row in rows if path.startswith(prefix)}
+
+    def update(self, directory: str) -> dict:
+        known = self.documents(directory)
+        counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "failed": 0}
+        for image_path in iter_image_files(directory):
+            counts[self.update_file(image_path, known.pop(image_path, None))] += 1
+        for image_path in known: #Whatever is left was not found on disk anymore
+            self.remove(image_path)
+            counts["removed"] += 1
+
+        return counts
+
+    def update_file(self, image_path: str, known: tuple = None) -> str:
+        image_path = os.path.abspath(image_path)
+        if known is None:
+            known = self.documents().get(image_path)
+        stat = os.stat(image_path)
+        if known is not None and (known[1], known[2]) == (stat.st_size, stat.st_mtime_ns):
+            return "unchanged"
+        digest = ocr_cache.digest(image_path) if ocr_cache is not None else file_sha256(image_path)
+        with self.lock:
+            if known is not None and known[3] == digest: #Touched, but the content is the same
+                self.db.execute("UPDATE documents SET size = ?, mtime_ns = ? WHERE id = ?", (stat.st_size, stat.st_mtime_ns, known[0]))
+                self.db.commit()
+                return "unchanged"
+        try:
+            result = ocr_scan_results(image_path)
+        except Exception as error: #One unreadable image must not stop the whole update
+            self.errors[image_path] = f"{type(error).__name__}: {error}"
+            count_event("failed")
+            if known is not None: #Its old text is not in the file anymore
+                self.remove(image_path)
+            return "failed"
+        self.errors.pop(image_path, None)
+        with self.lock:
+            if known is not None:
+                self.db.execute("DELETE FROM postings WHERE doc = ?", (known[0],))
+                self.db.execute("DELETE FROM vocabulary WHERE doc = ?", (known[0],))
+            self.db.execute("INSERT OR REPLACE INTO documents (id, path, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?)",
+                            (known[0] if known else None, image_path, stat.st_size, stat.st_mtime_ns, digest))
+            doc = self.db.execute("SELECT id FROM documents WHERE path = ?", (image_path,)).fetchone()[0]
+            rows = []
+            for bbox, text, confidence in result:
+                bbox = json.dumps(bbox, default=lambda o: o.tolist())
+                for term in tokenize(text): #Positions run across the lines so phrases can continue on the next line
+                    rows.append((term, doc, len(rows), bbox, float(confidence)))
+            self.db.executemany("INSERT INTO postings VALUES (?, ?, ?, ?, ?)", rows)
+            self._add_vocabulary(doc, [term for term, *_ in rows])
+            self.db.commit()
+
+        return "updated" if known is not None else "added"
+
+    def remove(self, image_path: str) -> None:
+        with self.lock:
+            row = self.db.execute("SELECT id FROM documents WHERE path = ?", (os.path.abspath(image_path),)).fetchone()
+            if row is not None:
+                self.db.execute("DELETE FROM postings WHERE doc = ?", (row[0],))
+                self.db.execute("DELETE FROM vocabulary WHERE doc = ?", (row[0],))
+                self.db.execute("DELETE FROM documents WHERE id = ?", (row[0],))
+                self.db.commit()
+
+    def _add_vocabulary(self, doc: int, terms: list[str]) -> None:
+        # Every term of the document, and every FUZZY_MAX_JOIN terms in a row joined together, as FuzzyIndex compares them
+        sequences = {" ".join(terms[start:start + length]) for start, length, _ in _joined_terms(terms, FUZZY_MAX_JOIN)}
+        rows = [(fuzzy_key(sequence), sequence, doc) for sequence in sequences]
+        self.db.executemany("INSERT INTO vocabulary VALUES (?, ?, ?)", rows)
+        tree = BKTree(self.db)
+        for key in {key for key, _, _ in rows}: #Only the keys the tree doesn't know yet are added to it
+            tree.add(key)
+
+    def _postings(self, term: str, directory: str = None) -> dict:
+        # path -> {position: (term, bbox, confidence)}; "wis*" matches every term starting with "wis"
+        if term.endswith("*"):
+            prefix = term.rstrip("*")
+            where, params = "p.term >= ? AND p.term < ?", [prefix, prefix + "\U0010ffff"]
+        else:
+            where, params = "p.term = ?", [term]
+        if directory is not None: #Only the images below directory, filtered by SQLite before any row reaches Python
+            prefix = os.path.join(os.path.abspath(directory), "")
+            where += " AND d.path >= ? AND d.path < ?"
+            params += [prefix, prefix + "\U0010ffff"]
+        with self.lock:
+            rows = self.db.execute("SELECT d.path, p.position, p.term, p.bbox, p.confidence FROM postings p "
+                                   f"JOIN documents d ON d.id = p.doc WHERE {where}", params).fetchall()
+        postings = {}
+        for path, position, term, bbox, confidence in rows:
+            postings.setdefault(path, {})[position] = (term, bbox, confidence)
+        return postings
+
+    def _match(self, terms: list[str], directory: str = None) -> dict:
+        # path -> hits of a single term, or of a phrase when several terms must follow each other
+        postings = [self._postings(term, directory) for term in terms]
+        hits = {}
+        for path in set.intersection(*[set(p) for p in postings]):
+            for start in postings[0][path]:
+                if all(start + i in postings[i][path] for i in range(1, len(postings))):
+                    hits.setdefault(path, []).extend((start + i, *postings[i][path][start + i]) for i in range(len(postings)))
+        return hits
+
+    def search_hits(self, query: str, directory: str = None) -> dict:
+        # Words are combined with AND, OR separates alternatives, "quotes" make a phrase and a trailing * a prefix
+        hits = {}
+        for clause in re.split(r"\s+OR\s+", query.strip()):
+            matches = []
+            for phrase, word in re.findall(r'"([^"]*)"|(\S+)', clause):
+                atom = phrase or word
+                terms = tokenize(atom)
+                if terms and atom.endswith("*"):
+                    terms[-1] += "*"
+                if terms:
+                    matches.append(self._match(terms, directory))
+            if not matches:
+                continue
+            for path in set.intersection(*[set(m) for m in matches]):
+                hits.setdefault(path, []).extend(hit for m in matches for hit in m[path])
+
+        return {path: [{"term": term, "position": position, "bbox": json.loads(bbox), "confidence": confidence}
+                       for position, term, bbox, confidence in sorted(set(path_hits))]
+                for path, path_hits in hits.items()}
+
+    def search(self, query: str, directory: str = None) -> list[str]:
+        return sorted(self.search_hits(query, directory))
+
+"""This code builds a persistent *inverted index* over the *OCR* results. Instead of running *OCR* on every image for every keyword, the text of each image is read once and every word is stored together with the images it appears in, so a keyword search becomes a lookup in the index. Here's a breakdown of how it works:
+
+**Finding the Images:**
+
+`iter_image_files` walks through the directory with `os.walk`, in the same way as `search_images`, and yields the absolute path of every file with one of the `IMAGE_EXTENSIONS`.
+
+**Tokenizing the Text:**
+
+`tokenize` splits a piece of text into lower case words. The same function is used for the text of the images and for the query, so both are compared in the same way.
+
+**The Index Tables:**
+
+The index is an *SQLite* database with two tables. `documents` stores the path, size, modification time and content hash of every indexed image. `postings` stores, for every word of every image, the word itself (the *term*), the image it belongs to, its position in the text of that image, and the bounding box and confidence of the text line it was found in. An index on the `term` column makes looking up a word fast, even for a very large number of images.
+
+**Incremental Updates:**
+
+`index.update(directory)` compares the images on disk with the documents already in the index. Files whose size and modification time did not change are skipped without being read. Files that changed are hashed, and only when their content is really different are they read again with `ocr_scan_results` (which also uses `ocr_cache`). Images that were deleted are removed from the index. The method returns how many images were added, updated, removed, left unchanged or could not be read. An image that can't be read (a corrupt file, for example) doesn't stop the update: the reason is kept in `index.errors`, and the image is tried again on the next update.
+
+**Querying the Index:**
+
+`index.search(query)` returns the paths of the images that match a query, and `index.search_hits(query)` also returns, for every image, the matching words with their positions, bounding boxes and confidences. The query language supports:
+
+* `wisdom knowledge` - both words must appear in the image (AND).
+* `wisdom OR knowledge` - either of the words must appear (OR).
+* `"ancient wisdom"` - the words must appear next to each other, in this order (phrase).
+* `wis*` - any word starting with `wis` (prefix).
+
+The optional `directory` parameter restricts the results to the images below that directory. The postings of a word are joined with the `documents` table, and filtered on the path of the image, by *SQLite* itself, so only the postings of the images below `directory` are loaded.
+
+`keyword_query(keyword)` turns a plain keyword into a query that behaves like the substring check of `search_images`: its words must follow each other, and the last one may be the start of a longer word, so `wis` finds `wisdom` and `ancient wis` finds `ancient wisdom`. Unlike a substring check, the first word must be a whole word, so `isdom` doesn't find `wisdom`. Keywords that already use the query syntax are left as they are.
+"""
+
+# Find keywords even when the OCR misread a few characters or split a word in two
+
+import itertools
+
+CONFUSABLES = (("rn", "m"), ("vv", "w"), ("0", "o"), ("1", "l"), ("i", "l"), ("|", "l"), ("5", "s"))
+
+def normalize_confusables(text: str) -> str:
+    # Characters that OCR often mixes up are written the same way, in the keyword and in the text
+    text = text.lower()
+    for seen, canonical in CONFUSABLES:
+        text = text.replace(seen, canonical)
+    return text
+
+def edit_distance(a: str, b: str, max_distance: int = None) -> int:
+    # Levenshtein distance; with max_distance it gives up early and returns max_distance + 1
+    if max_distance is not None and abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    start = 0 #What both words start and end with doesn't change the distance
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a, b = a[start:len(a) - end], b[start:len(b) - end]
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        left = i
+        for j, char_b in enumerate(b):
+            left = min(previous[j + 1] + 1, left + 1, previous[j] + (char_a != char_b))
+            current.append(left)
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+class BKTree:
+    # Every child is stored under its distance to the parent, so a search only visits the children that can be close enough.
+    # The nodes are rows of the bktree table of an OCRIndex, so the tree is built once and grows with the index
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def _root(self):
+        row = self.db.execute("SELECT key FROM bktree WHERE parent IS NULL").fetchone()
+        return row[0] if row else None
+
+    def add(self, word: str) -> None:
+        if self.db.execute("SELECT 1 FROM bktree WHERE key = ?", (word,)).fetchone():
+            return
+        node = self._root()
+        distance = None
+        while node is not None:
+            distance = edit_distance(word, node)
+            child = self.db.execute("SELECT key FROM bktree WHERE parent = ? AND distance = ?", (node, distance)).fetchone()
+            if child is None:
+                break
+            node = child[0]
+        self.db.execute("INSERT INTO bktree VALUES (?, ?, ?)", (word, node, distance))
+
+    def search(self, word: str, max_distance: int) -> list[tuple[int, str]]:
+        found = []
+        nodes = [root] if (root := self._root()) is not None else []
+        while nodes:
+            term = nodes.pop()
+            distance = edit_distance(word, term)
+            if distance <= max_distance:
+                found.append((distance, term))
+            nodes += [key for key, in self.db.execute("SELECT key FROM bktree WHERE parent = ? AND distance BETWEEN ? AND ?",
+                                                       (term, max(1, distance - max_distance), distance + max_distance))]
+        return sorted(found)
+
+def fuzzy_key(text: str) -> str:
+    # The keyword as it is compared: confusables normalized and without spaces, so "w isdom" and "wisdom" are the same
+    return "".join(tokenize(normalize_confusables(text)))
+
+def _joined_terms(terms: list[str], max_join: int):
+    for start in range(len(terms)):
+        for length in range(1, min(max_join, len(terms) - start) + 1):
+            yield start, length, "".join(terms[start:start + length])
+
+def fuzzy_find(keyword: str, result: list, max_distance: int = 1, max_join: int = None) -> list[tuple]:
+    # (distance, confidence, bbox, text) of every line of a readtext result close enough to the keyword, best first
+    query = fuzzy_key(keyword)
+    max_join = max_join or len(tokenize(keyword)) + 1 #One more word than the keyword has, for a word split in two
+    hits = []
+    for bbox, text, confidence in result:
+        terms = tokenize(normalize_confusables(text))
+        distance = min((edit_distance(query, key, max_distance) for _, _, key in _joined_terms(terms, max_join)),
+                       default=max_distance + 1)
+        if distance <= max_distance:
+            hits.append((distance, confidence, bbox, text))
+    return sorted(hits, key=lambda hit: (hit[0], -hit[1]))
+
+def fuzzy_contains(keyword: str, text: str, max_distance: int = 1) -> bool:
+    return bool(fuzzy_find(keyword, [(None, text, 1.0)], max_distance))
+
+class FuzzyIndex:
+    def __init__(self, index: OCRIndex):
+        self.index = index
+        self.tree = BKTree(index.db)
+        with index.lock:
+            empty = index.db.execute("SELECT NOT EXISTS (SELECT 1 FROM vocabulary)").fetchone()[0]
+            indexed = index.db.execute("SELECT EXISTS (SELECT 1 FROM postings)").fetchone()[0]
+        if empty and indexed: #An index made before it kept a vocabulary
+            self.refresh()
+
+    def refresh(self) -> None:
+        # Rebuilds the vocabulary and the tree from the postings; OCRIndex keeps them up to date on its own afterwards
+        with self.index.lock:
+            self.index.db.execute("DELETE FROM vocabulary")
+            self.index.db.execute("DELETE FROM bktree")
+            docs = itertools.groupby(self.index.db.execute("SELECT doc, term FROM postings ORDER BY doc, position").fetchall(),
+                                     key=lambda row: row[0])
+            for doc, rows in docs:
+                self.index._add_vocabulary(doc, [term for _, term in rows])
+            self.index.db.commit()
+
+    def search_hits(self, keyword: str, max_distance: int = 1, directory: str = None) -> list[dict]:
+        # The best hit of every matching image, the closest first and then the most confident
+        best = {}
+        with self.index.lock:
+            keys = self.tree.search(fuzzy_key(keyword), max_distance)
+            sequences = [(distance, sequence) for distance, key in keys
+                         for sequence, in self.index.db.execute("SELECT DISTINCT sequence FROM vocabulary WHERE key = ?", (key,))]
+        for distance, sequence in sequences: #Keys of removed images are still in the tree, but have no sequence anymore
+            for path, hits in self.index.search_hits(f'"{sequence}"', directory).items():
+                confidence = min(hit["confidence"] for hit in hits)
+                hit = {"path": path, "text": sequence, "distance": distance, "confidence": confidence,
+                       "bbox": hits[0]["bbox"]}
+                if path not in best or (distance, -confidence) < (best[path]["distance"], -best[path]["confidence"]):
+                    best[path] = hit
+        return sorted(best.values(), key=lambda hit: (hit["distance"], -hit["confidence"]))
+
+    def search(self, keyword: str, max_distance: int = 1, directory: str = None) -> list[str]:
+        return [hit["path"] for hit in self.search_hits(keyword, max_distance, directory)]
+
+"""This code adds *fuzzy* keyword matching, which still finds a keyword when the *OCR* made a mistake. An exact search for "wisdom" misses an image where *EasyOCR* read "wisd0m", "wisdorn" or "w isdom". Here's a breakdown of how it works:
+
+**Confusable Characters:**
+
+Some characters look so much alike that *OCR* often mixes them up, like `0` and `o`, `1`, `l` and `I`, or `rn` and `m`. `normalize_confusables` writes every group of them the same way (`CONFUSABLES` lists them), both in the keyword and in the text, so these mistakes don't count at all.
+
+**Edit Distance:**
+
+`edit_distance` counts how many characters have to be inserted, deleted or replaced to turn one word into the other (the *Levenshtein distance*). `max_distance` is how many such mistakes are allowed. With `max_distance` it stops as soon as the words can't be that close anymore.
+
+**Spaces:**
+
+The spaces are removed from the keyword, and the words of the text are also compared joined with the next one or two words, so "w isdom" matches "wisdom", and "ancient wisdom" also matches "ancientwisdom". Note that a fuzzy keyword has to match whole words, while the exact search also finds it inside a longer word.
+
+**Single Images:**
+
+`fuzzy_find(keyword, result, max_distance=1)` looks for the keyword in the `(bbox, text, confidence)` results of `readtext` and returns the matching lines with their distance, ranked by distance and then by the confidence *EasyOCR* gave them. `fuzzy_contains(keyword, text)` does the same for a plain string. `search_images` and `iter_search_images` use `fuzzy_find` on the lines of every image when given `max_distance`.
+
+**Searching the Index with a BK-tree:**
+
+Comparing the keyword with every word of every image gets slow for a large collection. `FuzzyIndex(index)` builds a *BK-tree* over the vocabulary of an `OCRIndex`, which is every different word, and every two or three words in a row joined together, after normalizing the confusables. In a *BK-tree* every word is stored under its distance to its parent, so a search for words within `max_distance` of the keyword only needs to look at a small part of the tree, and the time it takes grows much slower than the vocabulary. The words it finds are then looked up in the index, and `fuzzy_index.search_hits(keyword)` returns the best hit of every image, ranked by distance and then by confidence.
+
+The vocabulary and the tree are two more tables of the index database (`vocabulary` and `bktree`), and `OCRIndex` adds the words of every image it reads to them (`_add_vocabulary`), so they are built once and then grow with the index. Creating a `FuzzyIndex` and searching it never reads the whole index again, also in a new process. A *BK-tree* can't easily drop a word, so the words of removed images stay in the tree, but they have no rows left in `vocabulary` and are never returned. `fuzzy_index.refresh()` rebuilds both tables from the postings, which is only needed once, for an index made before they existed (this is done automatically), or to drop the old words from the tree.
+"""
+
+# Spread the OCR of many images over a pool of worker processes, each with its own reader
+
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
+
+_worker_reader = None
+_worker_lang_list = None
+
+def _init_ocr_worker(lang_list: list[str], torch_threads: int, loader: ImageLoader = None) -> None:
+    global _worker_reader, _worker_lang_list, image_loader
+    import easyocr
+    import torch
+    torch.set_num_threads(torch_threads) #Keep the workers from fighting over the same cores
+    _worker_reader = easyocr.Reader(lang_list)
+    _worker_lang_list = list(lang_list)
+    image_loader = loader #The same loader as the parent, also when the workers are spawned and not forked
+
+def _ocr_worker_fingerprint() -> str:
+    return reader_fingerprint(_worker_lang_list)
+
+def _ocr_worker_chunk(chunk: list, task=None) -> list:
+    results = []
+    for seq, image_path in chunk:
+        try:
+            if task is not None: #Something else than readtext, like the fields of a form
+                results.append((seq, image_path, task(_worker_reader, image_path), None))
+            elif isinstance(image_path, tuple): #A (path, page) pair: the worker renders the page itself
+                results.append((seq, image_path, read_page_text(_worker_reader, *image_path), None))
+            else:
+                results.append((seq, image_path, read_image_text(_worker_reader, image_path), None))
+        except Exception as error: #One unreadable image must not take the whole chunk down
+            results.append((seq, image_path, None, f"{type(error).__name__}: {error}"))
+    return results
+
+class BatchOCREngine:
+    def __init__(self, workers: int = None, torch_threads: int = 1, chunksize: int = 4, ordered: bool = True,
+                 lang_list: list[str] = ["en"], max_retries: int = 1, use_cache: bool = True, mp_context=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.torch_threads = torch_threads
+        self.chunksize = chunksize
+        self.ordered = ordered
+        self.lang_list = list(lang_list)
+        self.max_retries = max_retries
+        self.use_cache = use_cache
+        self.mp_context = multiprocessing.get_context(mp_context) if isinstance(mp_context, str) else mp_context
+        self.executor = None
+        self.fingerprint = None
+
+    def _start(self) -> None:
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=self.mp_context,
+            initializer=_init_ocr_worker, initargs=(self.lang_list, self.torch_threads, image_loader))
+        if self.fingerprint is None:
+            self.fingerprint = self.executor.submit(_ocr_worker_fingerprint).result()
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _cache_key(self, cache: OCRCache, source, task_key: str = "") -> tuple:
+        if isinstance(source, tuple): #A page of a multi-page file
+            digest = cache.digest(source[0])
+            return digest, cache.key(digest, f"{self.fingerprint}#page={source[1]}{task_key}")
+        digest = cache.digest(source)
+        return digest, cache.key(digest, self.fingerprint + task_key)
+
+    def scan(self, image_paths, task=None, task_key: str = ""):
+        # Yields (image_path, result, error) for every image; result is what readtext returns, error a message or None.
+        # task(reader, image_path) replaces readtext in the workers, and task_key tells its results apart in the cache
+        if self.executor is None:
+            self._start()
+        cache = ocr_cache if self.use_cache else None
+        paths = enumerate(image_paths)
+        in_flight = {} #future -> (chunk, attempts)
+        finished = {} #seq -> result, only used to put the results back in order
+        suspects = collections.deque() #images that were in flight when a worker crashed
+        next_seq = 0
+        exhausted = False
+
+        def submit(chunk, attempts) -> bool:
+            try:
+                future = self.executor.submit(_ocr_worker_chunk, chunk, task)
+            except BrokenProcessPool as error: #A worker died while we were still queuing: lost like the chunks in flight
+                future = concurrent.futures.Future()
+                future.set_exception(error)
+            in_flight[future] = (chunk, attempts)
+            return not future.done()
+
+        while True:
+            if suspects and not in_flight: #Retry suspects on their own, so a crash points at one image
+                seq, image_path, attempts = suspects.popleft()
+                submit([(seq, image_path)], attempts)
+            # Keep a bounded number of images in flight or waiting to be yielded, so memory doesn't grow with the directory,
+            #even when most of them come straight from the cache
+            while not suspects and not exhausted and len(in_flight) * self.chunksize + len(finished) < self.workers * 2 * self.chunksize:
+                chunk = []
+                for seq, image_path in paths:
+                    if cache is not None:
+                        try:
+                            digest, key = self._cache_key(cache, image_path, task_key)
+                            result = cache.get(key)
+                        except OSError as error:
+                            finished[seq] = (image_path, None, f"{type(error).__name__}: {error}")
+                            break
+                        if result is not None:
+                            count_event("cache_hits")
+                            finished[seq] = (image_path, result, None)
+                            break
+                    chunk.append((seq, image_path))
+                    if len(chunk) == self.chunksize:
+                        break
+                else:
+                    exhausted = True
+                if chunk and not submit(chunk, 0):
+                    break #The pool is broken, and is restarted below before anything else is queued
+                if finished and not self.ordered:
+                    break
+            if self.ordered:
+                while next_seq in finished:
+                    yield finished.pop(next_seq)
+                    next_seq += 1
+            else:
+                for seq in list(finished):
+                    yield finished.pop(seq)
+            if not in_flight:
+                if exhausted:
+                    return
+                continue
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            broken = []
+            for future in done:
+                chunk, attempts = in_flight.pop(future)
+                try:
+                    results = future.result()
+                except BrokenProcessPool:
+                    broken.append((chunk, attempts))
+                    continue
+                for seq, image_path, result, error in results:
+                    count_event("failed" if error is not None else "images")
+                    if result is not None and cache is not None:
+                        cache.put(*reversed(self._cache_key(cache, image_path, task_key)), result)
+                    finished[seq] = (image_path, result, error)
+            if broken:
+                # A worker died (out of memory, segfault in a decoder...): restart the pool and retry what was lost
+                broken += list(in_flight.values())
+                in_flight.clear()
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self._start()
+                alone = len(broken) == 1 and len(broken[0][0]) == 1
+                for chunk, attempts in broken:
+                    for seq, image_path in chunk:
+                        if alone and attempts >= self.max_retries:
+                            finished[seq] = (image_path, None, "worker process crashed")
+                        else:
+                            suspects.append((seq, image_path, attempts + 1))
+
+    def scan_files(self, image_paths):
+        # Like scan, with one result per file, but the pages of the multi-page files are read in parallel and joined again
+        ready, page_counts, pages = [], {}, {}
+        for item in itertools.chain(self.scan(expand_pages(image_paths, ready, page_counts)), [None]):
+            yield from ready
+            ready.clear()
+            if item is None:
+                return
+            source, result, error = item
+            if not isinstance(source, tuple):
+                yield item
+                continue
+            path, page = source
+            done = pages.setdefault(path, {})
+            done[page] = (result, error)
+            if len(done) == page_counts[path]: #The last page of the file came back
+                del pages[path]
+                errors = [error for _, error in done.values() if error is not None]
+                yield path, None if errors else [line for page in sorted(done) for line in done[page][0]], errors[0] if errors else None
+
+    def scan_directory(self, directory: str):
+        return self.scan_files(iter_image_files(directory))
+
+def ocr_scan_batch(image_paths: list[str], **engine_options) -> dict:
+    # The same text ocr_scan returns, for many images at once; failed images map to None
+    with BatchOCREngine(**engine_options) as engine:
+        return {image_path: None if error else " ".join([text for _, text, _ in result])
+                for image_path, result, error in engine.scan_files(image_paths)}
+
+def benchmark_batch_ocr(directory: str, worker_counts: list[int] = [1, 2, 4, 8, 16, 32], limit: int = 256, torch_threads: int = 1) -> list[dict]:
+    image_paths = list(itertools.islice(iter_image_files(directory), limit))
+    rows = []
+    for workers in worker_counts:
+        with BatchOCREngine(workers=workers, torch_threads=torch_threads, ordered=False, use_cache=False) as engine:
+            engine._start() #Don't count loading the readers
+            start = time.perf_counter()
+            failed = sum(error is not None for _, _, error in engine.scan(image_paths))
+            elapsed = time.perf_counter() - start
+        rows.append({"workers": workers, "images": len(image_paths), "failed": failed, "seconds": elapsed,
+                     "images_per_second": len(image_paths) / elapsed})
+    for row in rows:
+        speedup = row["images_per_second"] / rows[0]["images_per_second"]
+        print(f"{row['workers']:>3} workers: {row['images_per_second']:8.2f} images/sec, "
+              f"speedup {speedup:5.2f}x, efficiency {speedup / row['workers'] * rows[0]['workers']:5.0%}")
+
+    return rows
+
+"""This code adds a batch *OCR* engine that spreads the images of a directory over a pool of worker processes, so that all the cores of the machine are used instead of one. Here's a breakdown of how it works:
+
+**One Reader per Worker:**
+
+The pool is a `ProcessPoolExecutor`. When a worker process starts, `_init_ocr_worker` limits the number of threads *PyTorch* may use in it (`torch_threads`) and loads its own `easyocr.Reader`, which is then reused for every image the worker reads. The `image_loader` of the parent process is handed to every worker too, so the workers reduce the images the same way, whichever way the processes are started. With 32 workers and one thread each, the 32 cores are busy with 32 different images instead of sharing one.
+
+**Chunks and Result Order:**
+
+The image paths are sent to the workers in chunks of `chunksize` images, to keep the cost of talking to the workers low. Only a bounded number of images is in flight or waiting to be yielded at any time, results from the cache included, so the paths from a very large `os.walk` are never all held in memory. With `ordered=True` the results are yielded in the same order as the paths, and with `ordered=False` they are yielded as soon as they are ready.
+
+**Cache:**
+
+Before an image is sent to a worker, the engine looks it up in `ocr_cache`, and new results are stored there, exactly like `ocr_scan_results` does. `engine.scan(image_paths, task, task_key)` runs `task(reader, image_path)` in the workers instead of `readtext`, for example to read only the fields of a form, and adds `task_key` to the cache key, so its results are cached apart from the full-page ones.
+
+**Failures:**
+
+`engine.scan(image_paths)` yields `(image_path, result, error)` tuples, where `result` is the list returned by `readtext`. A corrupt image only produces an `error` message for that image. When a worker process crashes, the pool is restarted and the images that were lost are retried one by one, each on its own, so the image that crashes the worker can be singled out. Once it has crashed a worker on its own `max_retries` times, it is reported as failed and the scan goes on.
+
+**Same Results as `ocr_scan`:**
+
+`ocr_scan_batch(image_paths, workers=32)` returns a dictionary from each path to the same text `ocr_scan` would return (or `None` if the image failed). `engine.scan_files(image_paths)` is like `scan`, but the multi-page *PDF* and *TIFF* files are split into their pages, which are spread over the workers like single images, and the pages of every file are joined again into one result for the file. `engine.scan_directory(directory)` scans every file below a directory this way, and `search_images`, `iter_search_images` and the `OCRWatcher` use `scan_files` when they are given an `engine`.
+
+**Benchmark:**
+
+`benchmark_batch_ocr(directory)` scans the same images with 1, 2, 4, 8, 16 and 32 workers (without the cache) and prints the images per second, the speedup over one worker and the scaling efficiency, which should stay close to 100% as long as there are free cores.
+"""
+
+# Stream the matching images as soon as they are found, instead of waiting for the whole directory
+
+import queue
+
+def _is_cancelled(cancel) -> bool:
+    return cancel is not None and (cancel.is_set() if hasattr(cancel, "is_set") else cancel())
+
+def _walk_into_queue(directory: str, paths: queue.Queue, stop: threading.Event) -> None:
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                paths.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for image_path in iter_image_files(directory):
+            if not put(image_path):
+                return
+    finally:
+        put(None) #Tell the reading side that the walk is over
+
+def _iter_queue(paths: queue.Queue, cancel=None):
+    while not _is_cancelled(cancel):
+        image_path = paths.get()
+        if image_path is None:
+            return
+        yield image_path
+
+def iter_search_images(directory: str, keyword: str, limit: int = None, cancel=None, engine: BatchOCREngine = None, prefetch: int = 64,
+                       prefilter: "TextPrefilter" = None, max_distance: int = 0):
+    stop = threading.Event()
+    paths = queue.Queue(maxsize=prefetch) #Bounded, so a fast walk can't run ahead of the OCR with millions of paths
+    walker = threading.Thread(target=_walk_into_queue, args=(directory, paths, stop), daemon=True)
+    walker.start()
+    image_paths = _iter_queue(paths, cancel)
+    if prefilter is not None:
+        image_paths = prefiltered(image_paths, prefilter)
+    if engine is not None:
+        results = engine.scan_files(image_paths)
+    else:
+        results = ((image_path, ocr_scan_results(image_path), None) for image_path in image_paths)
+    found = 0
+    try:
+        for image_path, result, error in results:
+            if _is_cancelled(cancel): #The images already read by the engine's workers are dropped too
+                return
+            if error is not None:
+                count_event("failed")
+                continue
+            detected_text = " ".join([text for _, text, _ in result])
+            if keyword.lower() in detected_text.lower():
+                boxes = [bbox for bbox, text, _ in result if keyword.lower() in text.lower()] or [bbox for bbox, _, _ in result]
+            elif max_distance and (hits := fuzzy_find(keyword, result, max_distance)):
+                boxes = [bbox for _, _, bbox, _ in hits] #Best match first
+            else:
+                continue
+            yield image_path, detected_text, boxes
+            found += 1
+            if limit is not None and found >= limit:
+                return
+    finally:
+        stop.set() #Stops the walk when we are done early, cancelled or the caller stopped iterating
+        results.close()
+
+"""This code defines `iter_search_images`, a streaming version of `search_images`. Instead of returning a list after every image of the directory was read, it is a *generator* that yields each matching image as soon as it has been read. Here's a breakdown of how it works:
+
+**Walking and Reading at the Same Time:**
+
+The directory is walked with `iter_image_files` in a background thread (`_walk_into_queue`), which puts the image paths into a `queue.Queue`. The *OCR* runs in the calling thread and takes the paths from that queue, so the walk and the *OCR* overlap. The queue holds at most `prefetch` paths: when it is full the walk waits, so the memory used stays the same however many files the directory contains.
+
+**Yielded Results:**
+
+For every image that contains the keyword, the generator yields a tuple `(image_path, detected_text, boxes)`, where `boxes` are the bounding boxes of the text lines that contain the keyword (or of all the lines, when the keyword only appears across two lines).
+
+**Stopping Early:**
+
+`limit=1` stops after the first matching image, and any other `limit` after that many matches. The `cancel` parameter takes a `threading.Event`, or any function returning `True` when the search should stop, and is checked before every image is read and again before every result is yielded, so nothing more comes out once it is set, even from images the workers of an `engine` were already reading. Stopping the iteration in any of these ways, or with `break` in the caller's loop, also stops the background walk.
+
+**Using the Worker Pool:**
+
+With an `engine`, the images are read by the worker processes of a `BatchOCREngine`, which only holds a bounded number of images in flight. Images that fail to be read are skipped.
+
+**Skipping Images Without Text:**
+
+With a `prefilter` (a `TextPrefilter`, defined further down), images that don't look like they contain any text are skipped before they are read.
+
+**Allowing OCR Mistakes:**
+
+With `max_distance` set to 1 or more, images where the keyword was misread are also yielded, with the boxes of the lines that match best first.
+
+**Example Usage:**
+
+```
+for image_path, text, boxes in iter_search_images(".", "wisdom", limit=10):
+    print(image_path)
+```
+"""
+
+# Read many images at once: detect the text lines of every image, then recognize the lines of all of them in large batches
+
+RECOGNIZER_HEIGHT = 64 #Every text line is resized to this height before recognition (imgH in easyocr)
+
+def _detect_crops(reader, image) -> list:
+    # The same steps readtext takes before recognizing: one (box, crop, padded width) per detected text line
+    from easyocr.utils import get_image_list, reformat_input
+    img, img_cv_grey = reformat_input(image)
+    horizontal_list, free_list = reader.detect(img, reformat=False)
+    crops = []
+    for h_list, f_list in [([box], []) for box in horizontal_list[0]] + [([], [box]) for box in free_list[0]]:
+        image_list, max_width = get_image_list(h_list, f_list, img_cv_grey, model_height=RECOGNIZER_HEIGHT)
+        crops += [(box, crop, int(max_width)) for box, crop in image_list]
+    return crops
+
+def ocr_scan_many_results(images: list, batch_size: int = 64, chunk_images: int = 32, use_cache: bool = True,
+                          lang_list: list[str] = ['en']) -> list:
+    cache = ocr_cache if use_cache else None
+    fingerprint = reader_fingerprint(lang_list)
+    reader = ignore_char = None
+    results = []
+    for start in range(0, len(images), chunk_images):
+        chunk = images[start:start + chunk_images]
+        chunk_results = [None] * len(chunk)
+        misses = {} #position in the chunk -> (cache key, digest)
+        if cache is not None: #Look the whole chunk up first, so a chunk that is all in the cache never needs the reader
+            for i, image in enumerate(chunk):
+                if isinstance(image, str) and not is_multipage(image):
+                    digest = cache.digest(image)
+                    key = cache.key(digest, fingerprint)
+                    chunk_results[i] = cache.get(key)
+                    if chunk_results[i] is None:
+                        misses[i] = (key, digest)
+        to_read = [i for i, result in enumerate(chunk_results) if result is None]
+        if to_read and reader is None: #Only now, at the first image that isn't in the cache, is the reader (and its models) loaded
+            from easyocr.recognition import get_text
+            reader = get_reader(lang_list)
+            ignore_char = "".join(set(reader.character) - set(reader.lang_char))
+        scales = {}
+        by_width = {}
+        for i in to_read:
+            image = chunk[i]
+            if isinstance(image, str) and is_multipage(image): #Pages are read one at a time, and cached per page
+                chunk_results[i] = ocr_scan_results(image, lang_list) if cache is not None else read_image_text(reader, image)
+                continue
+            if reader.model_lang == "arabic": #readtext also reorders arabic text, so leave those to it
+                chunk_results[i] = read_image_text(reader, image) if isinstance(image, str) else reader.readtext(image)
+                continue
+            if image_loader is not None and isinstance(image, str):
+                image, scales[i] = image_loader.load(image)
+            with stage_timer("detect"):
+                crops = _detect_crops(reader, image)
+            count_event("images")
+            count_event("crops", len(crops))
+            chunk_results[i] = [None] * len(crops)
+            for n, (box, crop, width) in enumerate(crops):
+                by_width.setdefault(width, []).append((i, n, box, crop))
+        # Lines padded to the same width give the same text in a batch as they do on their own
+        for width, group in by_width.items():
+            for batch_start in range(0, len(group), batch_size):
+                batch = group[batch_start:batch_start + batch_size]
+                with stage_timer("recognize"):
+                    lines = get_text(reader.character, RECOGNIZER_HEIGHT, width, reader.recognizer, reader.converter,
+                                     [(box, crop) for _, _, box, crop in batch], ignore_char=ignore_char,
+                                     batch_size=batch_size, workers=0, device=reader.device)
+                for (i, n, _, _), line in zip(batch, lines):
+                    chunk_results[i][n] = line
+        for i, scale in scales.items():
+            chunk_results[i] = image_loader.rescale(chunk_results[i], scale)
+        for i, (key, digest) in misses.items():
+            cache.put(key, digest, chunk_results[i])
+        results += chunk_results
+
+    return results
+
+def ocr_scan_many(images: list, **options) -> list[str]:
+    return [" ".join([text for _, text, _ in result]) for result in ocr_scan_many_results(images, **options)]
+
+def benchmark_ocr_scan_many(image_paths: list[str], batch_size: int = 64) -> dict:
+    reader = get_reader()
+    start = time.perf_counter()
+    one_by_one = [reader.readtext(image_path) for image_path in image_paths]
+    loop_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = ocr_scan_many_results(image_paths, batch_size=batch_size, use_cache=False)
+    batched_seconds = time.perf_counter() - start
+    crops = sum(len(result) for result in one_by_one)
+    report = {
+        "images": len(image_paths), "crops": crops,
+        "loop_images_per_second": len(image_paths) / loop_seconds, "loop_crops_per_second": crops / loop_seconds,
+        "batched_images_per_second": len(image_paths) / batched_seconds, "batched_crops_per_second": crops / batched_seconds,
+        "different_results": sum([text for _, text, _ in a] != [text for _, text, _ in b] for a, b in zip(one_by_one, batched)),
+    }
+    print(f"readtext loop:  {report['loop_images_per_second']:8.2f} images/sec {report['loop_crops_per_second']:9.2f} crops/sec")
+    print(f"ocr_scan_many:  {report['batched_images_per_second']:8.2f} images/sec {report['batched_crops_per_second']:9.2f} crops/sec")
+    print(f"speedup {loop_seconds / batched_seconds:.2f}x, {report['different_results']} of {len(image_paths)} images with different text")
+
+    return report
+
+"""This code adds `ocr_scan_many`, which reads a list of images at once and is faster than calling `ocr_scan` on each of them, especially on a CPU. Here's a breakdown of how it works:
+
+**Why Batches Help:**
+
+`readtext` works in two steps: *detection* finds the text lines in the image, and *recognition* turns every text line into text. On a CPU, `readtext` recognizes the text lines one at a time, so the recognition model is called many times with a single small line. Running the model once on a batch of lines is much cheaper than running it on every line alone.
+
+**Detection per Image:**
+
+`_detect_crops` takes the same steps as `readtext`: `reformat_input` loads the image, `reader.detect` finds the text lines, and `get_image_list` cuts every line out of the grey image (a *crop*) and resizes it to a height of `RECOGNIZER_HEIGHT` pixels. For every crop it also returns the width the line is padded to before it is recognized.
+
+**Recognition in Batches:**
+
+The crops of up to `chunk_images` images are grouped by their padded width, and every group is sent to the recognizer (`get_text`) in batches of up to `batch_size` crops. Because all the crops of a batch have the same width, no extra padding is added, and every line is recognized as `readtext` would recognize it on its own. The recognized lines are then put back in their image, in the same order as `readtext` returns them, so every result matches what `ocr_scan_results` returns. (On a CPU, *EasyOCR* quantizes the recognition model, and the quantization depends a little on the whole batch, so a confidence can differ in its last digits.) Images that are already in `ocr_cache` are taken from it, and new results are stored there. The images of a chunk are all looked up in the cache first, and the reader is only created at the first image that isn't there, so when every image is cached, *EasyOCR* and its models are never loaded. Multi-page files are read page by page through `ocr_scan_results`, and cached per page.
+
+**Using It:**
+
+`ocr_scan_many(image_paths)` returns a list with the same text `ocr_scan` returns for every image, and `ocr_scan_many_results(image_paths)` the full `(bbox, text, confidence)` results. Besides paths, the images can also be image bytes or *numpy* arrays.
+
+**Benchmark:**
+
+`benchmark_ocr_scan_many(image_paths)` reads the same images with a `readtext` loop and with `ocr_scan_many` (without the cache), and prints the images and text lines (crops) per second of both, the speedup, and how many images got a different text.
+"""
+
+# Skip images that contain no text with a cheap check before the full OCR
+
+class TextPrefilter:
+    def __init__(self, max_side: int = 256, min_contrast: float = 10.0, edge_threshold: float = 40.0,
+                 min_edge_density: float = 0.01, max_edge_density: float = 0.4, min_row_variation: float = 0.4,
+                 use_detector: bool = False, detector_side: int = 640):
+        self.max_side = max_side
+        self.min_contrast = min_contrast
+        self.edge_threshold = edge_threshold
+        self.min_edge_density = min_edge_density
+        self.max_edge_density = max_edge_density
+        self.min_row_variation = min_row_variation
+        self.use_detector = use_detector
+        self.detector_side = detector_side
+        self.skipped = {} #image path -> why it was skipped
+
+    def check(self, image_path: str) -> tuple[bool, str]:
+        import numpy as np
+        from PIL import Image
+        if is_multipage(image_path): #Only single images are checked
+            return True, ""
+        with Image.open(image_path) as image:
+            image.draft("L", (self.max_side, self.max_side)) #JPEGs are decoded straight at a fraction of their size
+            image = image.convert("L")
+            image.thumbnail((self.max_side, self.max_side))
+            pixels = np.asarray(image, dtype=np.float32)
+        contrast = float(pixels.std())
+        if contrast < self.min_contrast:
+            return False, f"contrast {contrast:.1f} below {self.min_contrast}"
+        edges = (np.abs(np.diff(pixels, axis=1))[:-1, :] + np.abs(np.diff(pixels, axis=0))[:, :-1]) > self.edge_threshold
+        density = float(edges.mean())
+        if density < self.min_edge_density:
+            return False, f"edge density {density:.3f} below {self.min_edge_density}"
+        if density > self.max_edge_density:
+            return False, f"edge density {density:.3f} above {self.max_edge_density}"
+        # Lines of text make rows full of edges alternate with empty rows between the lines
+        rows = edges.mean(axis=1)
+        variation = float(rows.std() / rows.mean())
+        if variation < self.min_row_variation:
+            return False, f"row variation {variation:.2f} below {self.min_row_variation}"
+        if self.use_detector:
+            with Image.open(image_path) as image:
+                image.draft("RGB", (self.detector_side, self.detector_side))
+                image = image.convert("RGB")
+                image.thumbnail((self.detector_side, self.detector_side))
+                horizontal_list, free_list = get_reader().detect(np.asarray(image), canvas_size=self.detector_side)
+            if not horizontal_list[0] and not free_list[0]:
+                return False, f"no text found by the detector at {self.detector_side} px"
+
+        return True, ""
+
+    def __call__(self, image_path: str) -> bool:
+        keep, reason = self.check(image_path)
+        if not keep:
+            self.skipped[image_path] = reason
+        return keep
+
+def prefiltered(image_paths, prefilter: TextPrefilter):
+    # The image paths the prefilter keeps, counting the skipped ones when metrics are on
+    for image_path in image_paths:
+        if prefilter(image_path):
+            yield image_path
+        else:
+            count_event("skipped")
+
+def evaluate_prefilter(prefilter: TextPrefilter, labels: dict) -> dict:
+    # labels maps image paths to True when the image contains text; every image is also read with OCR to time it
+    reader = get_reader()
+    counts = {"true_positive": 0, "false_positive": 0, "true_negative": 0, "false_negative": 0}
+    prefilter_seconds = saved_seconds = ocr_seconds = 0.0
+    for image_path, has_text in labels.items():
+        start = time.perf_counter()
+        keep = prefilter(image_path)
+        prefilter_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        reader.readtext(image_path)
+        elapsed = time.perf_counter() - start
+        ocr_seconds += elapsed
+        if not keep:
+            saved_seconds += elapsed
+        counts[("true_" if keep == has_text else "false_") + ("positive" if keep else "negative")] += 1
+    kept = counts["true_positive"] + counts["false_positive"]
+    with_text = counts["true_positive"] + counts["false_negative"]
+    report = dict(counts,
+                  precision=counts["true_positive"] / kept if kept else 1.0,
+                  recall=counts["true_positive"] / with_text if with_text else 1.0,
+                  ocr_seconds=ocr_seconds, prefilter_seconds=prefilter_seconds,
+                  seconds_saved=saved_seconds - prefilter_seconds)
+    print(f"precision {report['precision']:.3f}, recall {report['recall']:.3f} "
+          f"({counts['false_negative']} images with text skipped, {counts['true_negative']} without text skipped)")
+    print(f"OCR of every image: {ocr_seconds:.1f} s, pre-filter: {prefilter_seconds:.1f} s, "
+          f"time saved: {report['seconds_saved']:.1f} s ({report['seconds_saved'] / ocr_seconds:.0%})")
+    for image_path, reason in prefilter.skipped.items():
+        if labels.get(image_path):
+            print(f"  skipped, but has text: {image_path} ({reason})")
+
+    return report
+
+def load_prefilter_labels(directory: str) -> dict:
+    # A labelled sample set: the images in directory/text contain text, the images in directory/no_text don't
+    return {image_path: label == "text"
+            for label in ("text", "no_text")
+            for image_path in iter_image_files(os.path.join(directory, label))}
+
+"""This code adds an optional *pre-filter*, a cheap check that skips images without any text before they go through the full *OCR*. Many of the images picked up by their extension are photos, blank pages or scanned separator pages, and reading them with *EasyOCR* costs as much as reading a page full of text. Here's a breakdown of how it works:
+
+**Looking at a Small Version of the Image:**
+
+`TextPrefilter.check` opens the image at no more than `max_side` pixels. For *JPEG* files, `image.draft` makes *Pillow* decode the image directly at a fraction of its size, which is much faster than decoding it fully. The image is converted to grey and turned into a *numpy* array.
+
+**The Checks:**
+
+* **Contrast** - the standard deviation of the grey values. Blank and almost blank pages have a contrast below `min_contrast`.
+* **Edge density** - the share of pixels where the grey value changes by more than `edge_threshold` to the next pixel. Pages without text have very few edges (below `min_edge_density`), and noise, textures and busy photos have edges almost everywhere (above `max_edge_density`).
+* **Row variation** - text is written in lines, so rows full of edges alternate with the empty space between the lines. The variation of the edge density from row to row is low for photos and high for text.
+* **Detector** (optional) - with `use_detector=True`, the images that passed the other checks are also given to the *EasyOCR* text detector at a reduced size of `detector_side` pixels, and are skipped when it doesn't find any text. This is slower than the other checks, but still much cheaper than the full *OCR*.
+
+All the thresholds are parameters, so they can be tuned to the images at hand.
+
+**Using the Pre-filter:**
+
+A `TextPrefilter` is called with an image path and returns `True` when the image should be read. Every skipped image is recorded in `prefilter.skipped`, together with the reason why it was skipped. `search_images` and `iter_search_images` take it as their `prefilter` parameter, also when the images are read by a `BatchOCREngine`; `prefiltered(image_paths, prefilter)` is the generator they use to drop the skipped paths.
+
+**Can It Be Trusted?**
+
+`evaluate_prefilter(prefilter, labels)` checks the pre-filter against a labelled sample set. `load_prefilter_labels(directory)` builds the labels from a directory with a `text` and a `no_text` folder. Every image is checked with the pre-filter and also read with *OCR*, and the report shows:
+
+* the *precision* - how many of the images that were kept really contain text,
+* the *recall* - how many of the images with text were kept, which should stay very close to 1, because an image with text that is skipped is never found by a search,
+* the time the *OCR* of all images took, the time the pre-filter took, and the time it saves,
+* every image with text that was skipped, with the reason, to help tune the thresholds.
+"""
+
+# Run the OCR as a local service, so other programs can share one warm reader
+
+import http.client
+import http.server
+import io
+import socket
+import socketserver
+import urllib.parse
+
+def latency_percentiles(samples: list[float]) -> dict:
+    if len(samples) < 2:
+        value = samples[0] if samples else None
+        return {"p50": value, "p95": value, "p99": value}
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+class OCRService:
+    def __init__(self, batch_window: float = 0.01, max_batch: int = 32, max_queue: int = 256,
+                 warm: list[list[str]] = [["en"]], use_cache: bool = True, history: int = 10000, request_timeout: float = 60):
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.use_cache = use_cache
+        self.request_timeout = request_timeout #How long a request handler waits for its result
+        self.queues = {} #language list -> queue of (image, future, time it was queued)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.latencies = collections.deque(maxlen=history) #Seconds from queued to answered
+        self.batch_sizes = collections.deque(maxlen=history)
+        self.rejected = 0
+        self.failed = 0
+        self.max_depth = 0
+        for lang_list in warm:
+            get_reader(lang_list) #Load the models now, not on the first request
+            self._queue(lang_list)
+
+    def _queue(self, lang_list: list[str]) -> queue.Queue:
+        key = tuple(lang_list)
+        with self.lock:
+            if key not in self.queues:
+                self.queues[key] = queue.Queue(self.max_queue)
+                threading.Thread(target=self._batcher, args=(list(key), self.queues[key]), daemon=True,
+                                 name=f"ocr-batcher-{'-'.join(key)}").start()
+            return self.queues[key]
+
+    def submit(self, image, lang_list: list[str] = ['en']) -> concurrent.futures.Future:
+        # image is a path, image bytes or a grey numpy array; raises queue.Full when the service is overloaded
+        requests = self._queue(lang_list)
+        future = concurrent.futures.Future()
+        try:
+            requests.put_nowait((image, future, time.perf_counter()))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise
+        with self.lock:
+            self.max_depth = max(self.max_depth, requests.qsize())
+        if self.stopping.is_set(): #Closed while we were queuing: no batcher is left to answer it
+            self._fail_pending(requests)
+        return future
+
+    def ocr(self, image, lang_list: list[str] = ['en'], timeout: float = None) -> list:
+        return self.submit(image, lang_list).result(timeout)
+
+    def _batcher(self, lang_list: list[str], requests: queue.Queue) -> None:
+        while not self.stopping.is_set():
+            try:
+                batch = [requests.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            # Wait up to batch_window for more requests to come in, so they can be recognized together
+            deadline = time.perf_counter() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._run(lang_list, batch)
+
+    def _run(self, lang_list: list[str], batch: list) -> None:
+        try:
+            results = ocr_scan_many_results([image for image, _, _ in batch], batch_size=64,
+                                            use_cache=self.use_cache, lang_list=lang_list)
+        except Exception as error:
+            if len(batch) > 1: #Read them one by one, so only the bad image gets the error
+                for request in batch:
+                    self._run(lang_list, [request])
+                return
+            results = [error]
+        done = time.perf_counter()
+        with self.lock:
+            self.batch_sizes.append(len(batch))
+            for (_, _, queued), result in zip(batch, results):
+                self.latencies.append(done - queued)
+                self.failed += isinstance(result, Exception)
+        for (_, future, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self, reset: bool = False) -> dict:
+        with self.lock:
+            latencies = [latency * 1000 for latency in self.latencies]
+            report = {"requests": len(latencies), "rejected": self.rejected, "failed": self.failed,
+                      "latency_ms": latency_percentiles(latencies),
+                      "mean_batch_size": statistics.fmean(self.batch_sizes) if self.batch_sizes else None,
+                      "queue_depth": {" ".join(key): requests.qsize() for key, requests in self.queues.items()},
+                      "max_queue_depth": self.max_depth, "max_queue": self.max_queue}
+            if reset:
+                self.latencies.clear()
+                self.batch_sizes.clear()
+                self.rejected = self.failed = self.max_depth = 0
+        return report
+
+    def _fail_pending(self, requests: queue.Queue) -> None:
+        while True:
+            try:
+                _, future, _ = requests.get_nowait()
+            except queue.Empty:
+                return
+            future.set_exception(RuntimeError("the OCR service was closed"))
+
+    def close(self) -> None:
+        # The batchers finish the batch they are reading; the requests still queued get an error instead of waiting forever
+        self.stopping.set()
+        with self.lock:
+            queues = list(self.queues.values())
+        for requests in queues:
+            self._fail_pending(requests)
+
+def decode_image(data: bytes):
+    import numpy as np
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        return np.asarray(image.convert("L"))
+
+class OCRRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" #Keep the connection open between requests
+
+    def setup(self) -> None:
+        # The headers and the body are written separately, so don't let TCP hold the body back (Unix sockets have no such delay)
+        self.disable_nagle_algorithm = self.request.family in (socket.AF_INET, socket.AF_INET6)
+        super().setup()
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/stats":
+            reset = urllib.parse.parse_qs(url.query).get("reset") == ["1"]
+            self._send(200, self.server.service.stats(reset))
+        elif url.path == "/health":
+            self._send(200, {"ok": True})
+        elif url.path == "/metrics":
+            self._send_metrics()
+        else:
+            self._send(404, {"error": f"no such endpoint: {url.path}"})
+
+    def do_POST(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if url.path != "/ocr":
+            self._send(404, {"error": f"no such endpoint: {url.path}"})
+            return
+        # Either JSON like {"path": "/scans/page.png", "lang": ["en"]}, or the bytes of the image with ?lang=en,es
+        lang_list = urllib.parse.parse_qs(url.query).get("lang", ["en"])[0].split(",")
+        try:
+            if self.headers.get_content_type() == "application/json":
+                request = json.loads(body)
+                image = request["path"]
+                lang_list = request.get("lang", lang_list)
+            else:
+                with stage_timer("decode"):
+                    image = decode_image(body) #Decoded here, in the thread of this request, not in the batcher
+        except Exception as error:
+            self._send(400, {"error": f"{type(error).__name__}: {error}"})
+            return
+        try:
+            result = self.server.service.ocr(image, lang_list, self.server.service.request_timeout)
+        except queue.Full:
+            self._send(503, {"error": "too many requests in the queue, try again later"}, {"Retry-After": "1"})
+            return
+        except concurrent.futures.TimeoutError:
+            self._send(504, {"error": f"no result within {self.server.service.request_timeout} seconds"})
+            return
+        except Exception as error:
+            status = 503 if self.server.service.stopping.is_set() else 500 #Failed by close(), not by the image
+            self._send(status, {"error": f"{type(error).__name__}: {error}"})
+            return
+        self._send(200, {"text": " ".join([text for _, text, _ in result]),
+                         "lines": [{"box": box, "text": text, "confidence": confidence} for box, text, confidence in result]})
+
+    def _send_metrics(self) -> None:
+        # Prometheus text format: the latency of the service, and the pipeline stages when metrics are on
+        stats = self.server.service.stats()
+        lines = ["# TYPE ocr_service_latency_seconds summary"]
+        lines += [f'ocr_service_latency_seconds{{quantile="0.{name[1:]}"}} {value / 1000}'
+                  for name, value in stats["latency_ms"].items() if value is not None]
+        lines += ["# TYPE ocr_service_queue_depth gauge"]
+        lines += [f'ocr_service_queue_depth{{lang="{lang}"}} {depth}' for lang, depth in stats["queue_depth"].items()]
+        lines += ["# TYPE ocr_service_rejected_total counter", f"ocr_service_rejected_total {stats['rejected']}"]
+        data = ("\n".join(lines) + "\n" + (metrics.prometheus() if metrics is not None else "")).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send(self, status: int, body: dict, headers: dict = {}) -> None:
+        data = json.dumps(body, default=lambda value: value.tolist()).encode() #numpy numbers to plain ones
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass #Printing a line for every request would cost more than recognizing a small image
+
+class ThreadingOCRServer(http.server.ThreadingHTTPServer):
+    request_queue_size = 128 #Many clients connecting at once must not be turned away before the queue is even reached
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def make_ocr_server(address, **service_options):
+    # address is (host, port) for HTTP over TCP, or the path of a Unix socket
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.remove(address) #Left behind by a service that was stopped
+        server = ThreadingUnixHTTPServer(address, OCRRequestHandler)
+    else:
+        server = ThreadingOCRServer(address, OCRRequestHandler)
+    server.service = OCRService(**service_options)
+    return server
+
+def serve_ocr(address=("127.0.0.1", 8000), **service_options) -> None:
+    server = make_ocr_server(address, **service_options)
+    print(f"OCR service listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class OCRClient:
+    # One connection to the service; use one client per thread
+    def __init__(self, address=("127.0.0.1", 8000), timeout: float = 60):
+        if isinstance(address, str):
+            self.connection = UnixHTTPConnection(address, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(*address, timeout=timeout)
+
+    def _request(self, method: str, url: str, body: bytes = None, headers: dict = {}) -> tuple[int, dict]:
+        self.connection.request(method, url, body, headers)
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def ocr(self, path: str = None, data: bytes = None, lang_list: list[str] = ['en']) -> tuple[int, dict]:
+        if data is not None:
+            return self._request("POST", f"/ocr?lang={','.join(lang_list)}", data, {"Content-Type": "application/octet-stream"})
+        return self._request("POST", "/ocr", json.dumps({"path": path, "lang": lang_list}).encode(),
+                             {"Content-Type": "application/json"})
+
+    def stats(self, reset: bool = False) -> dict:
+        return self._request("GET", "/stats?reset=1" if reset else "/stats")[1]
+
+    def close(self) -> None:
+        self.connection.close()
+
+def benchmark_service(address, image_paths: list[str], concurrency: list[int] = [1, 4, 16, 64], requests: int = 256,
+                      send_bytes: bool = False) -> list[dict]:
+    # Load generator: `concurrency` clients send `requests` requests as fast as they get their answers
+    images = [open(image_path, "rb").read() if send_bytes else image_path for image_path in image_paths]
+    rows = []
+    for clients in concurrency:
+        OCRClient(address).stats(reset=True)
+        jobs = itertools.count()
+        latencies, statuses, lock = [], collections.Counter(), threading.Lock()
+
+        def run_client() -> None:
+            client = OCRClient(address)
+            while (job := next(jobs)) < requests:
+                image = images[job % len(images)]
+                start = time.perf_counter()
+                try:
+                    status, _ = client.ocr(data=image) if send_bytes else client.ocr(path=image)
+                except (OSError, http.client.HTTPException):
+                    status = "connection error"
+                    client.close() #Connect again for the next request
+                with lock:
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    statuses[status] += 1
+            client.close()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=run_client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        server = OCRClient(address).stats()
+        rows.append({"clients": clients, "requests": requests, "seconds": elapsed, "requests_per_second": requests / elapsed,
+                     "latency_ms": latency_percentiles(latencies), "statuses": dict(statuses), "server": server})
+    for row in rows:
+        latency = row["latency_ms"]
+        print(f"{row['clients']:>3} clients: {row['requests_per_second']:8.2f} requests/sec, p50 {latency['p50']:7.1f} ms, "
+              f"p95 {latency['p95']:7.1f} ms, p99 {latency['p99']:7.1f} ms, mean batch {row['server']['mean_batch_size'] or 0:5.1f}, "
+              f"max queue {row['server']['max_queue_depth']}, rejected {row['statuses'].get(503, 0)}")
+
+    return rows
+
+if __name__ == "__main__" and sys.argv[1:2] == ["serve"]:
+    parser = argparse.ArgumentParser(prog="ocr_and_python.py serve", description="Run the OCR as a local HTTP service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--socket", help="listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--lang", action="append", help="language list to keep warm, like en or en,es (can be repeated)")
+    parser.add_argument("--batch-window", type=float, default=0.01, help="seconds to wait for more requests to batch")
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--max-queue", type=int, default=256)
+    options = parser.parse_args(sys.argv[2:])
+    serve_ocr(options.socket or (options.host, options.port), batch_window=options.batch_window, max_batch=options.max_batch,
+              max_queue=options.max_queue, warm=[lang.split(",") for lang in options.lang or ["en"]])
+    sys.exit()
+
+"""This code runs the *OCR* as a long-running local service. Every run of the script has to load *PyTorch* and the models again, which takes several seconds, and `main()` waits for someone to type at the keyboard. The service loads the readers once and keeps them warm, so other programs can send it images over *HTTP* and get the text back right away. Here's a breakdown of how it works:
+
+**Starting the Service:**
+
+`python ocr_and_python.py serve` starts the service on `127.0.0.1:8000`. `--socket /tmp/ocr.sock` listens on a *Unix socket* instead, which is a little faster and can't be reached from other machines. `--lang en,es` chooses the languages whose reader is loaded at the start (it can be repeated), and readers for other languages are loaded the first time they are asked for. From a notebook, `make_ocr_server(address)` creates the server, which can be run with `threading.Thread(target=server.serve_forever, daemon=True).start()`.
+
+**Endpoints:**
+
+* `POST /ocr` with the bytes of an image (and `?lang=en,es` for other languages), or with *JSON* like `{"path": "/scans/page.png", "lang": ["en"]}` to read a file the service can open itself. The answer is *JSON* with the `text`, as returned by `ocr_scan`, and the `lines` with their box, text and confidence.
+* `GET /stats` returns the latency percentiles (*p50*, *p95* and *p99* in milliseconds, from the moment a request is queued until it is answered), the mean batch size, the current and the highest queue depth, and the number of rejected and failed requests. `GET /stats?reset=1` also starts the statistics over.
+* `GET /health` answers as soon as the service is up.
+* `GET /metrics` returns the latency percentiles, queue depths and rejected requests in the *Prometheus* text format, together with the stages of the pipeline when `metrics` are turned on (see the instrumentation section).
+
+**Micro-batching:**
+
+Every request is handled in its own thread, which decodes the image and puts it in the queue of its language list. One batcher thread per language list takes the first request from the queue, waits up to `batch_window` seconds (10 milliseconds by default) for more requests, up to `max_batch`, and reads all of them with `ocr_scan_many_results`, which recognizes the text lines of all the images together. When many requests come in at once, this gives much higher throughput than reading them one by one, and when only a few come in, they wait at most `batch_window` longer. Paths go through `ocr_cache` like everywhere else.
+
+**Backpressure:**
+
+Each queue holds at most `max_queue` requests. When it is full, the service doesn't keep piling up work it can't finish: it answers right away with status `503` and a `Retry-After` header, so the clients know to slow down. A request handler waits at most `request_timeout` seconds (60 by default) for its result, and answers with status `504` when it takes longer. `service.close()` stops the batchers and fails the requests that are still in the queues, so their handlers answer with status `503` instead of waiting for a result that will never come.
+
+**Load Generator:**
+
+`benchmark_service(address, image_paths)` sends `requests` requests to a running service from 1, 4, 16 and 64 clients at the same time, each with its own connection (`OCRClient`), and prints the requests per second, the latency percentiles seen by the clients, the mean batch size, the highest queue depth and the number of rejected requests. With `send_bytes=True` the clients send the image bytes instead of the paths.
+"""
+
+# Watch a directory and only read the images that are new or changed
+
+def iter_image_stats(directory: str):
+    # Yields (path, size, mtime_ns) of every image below directory; os.scandir already knows which entries are directories
+    stack = [os.path.abspath(directory)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue #Removed while we were walking, or not allowed to read it
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime_ns
+                except OSError:
+                    continue
+
+class JSONLSink:
+    # Appends one JSON line per record and flushes it, so a reader following the file sees every result right away
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record: dict) -> None:
+        line = json.dumps(record, default=lambda o: o.tolist()) + "\n"
+        with self.lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(line)
+
+class OCRWatcher:
+    def __init__(self, directory: str, sink="ocr_results.jsonl", manifest: str = None, engine: BatchOCREngine = None,
+                 index: OCRIndex = None, settle: float = 2.0):
+        self.directory = os.path.abspath(directory)
+        self.emit = sink if callable(sink) else JSONLSink(sink)
+        self.engine = engine
+        self.index = index
+        self.settle = settle
+        path = manifest or os.path.join(os.path.expanduser("~"), ".cache", "ocr_and_python", "watch_manifest.sqlite3")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS manifest (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT) WITHOUT ROWID")
+        self.db.commit()
+        self.committed = time.monotonic()
+
+    def manifest(self) -> dict:
+        # path -> (size, mtime_ns, digest) of every file below the directory that was already handled
+        prefix = os.path.join(self.directory, "")
+        rows = self.db.execute("SELECT path, size, mtime_ns, digest FROM manifest WHERE path >= ? AND path < ?",
+                               (prefix, prefix + "\U0010ffff"))
+        return {path: (size, mtime_ns, digest) for path, size, mtime_ns, digest in rows}
+
+    def scan(self) -> dict:
+        known = self.manifest()
+        counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "failed": 0, "waiting": 0}
+        settled = time.time_ns() - int(self.settle * 1e9)
+        changed = {}
+        for path, size, mtime_ns in iter_image_stats(self.directory):
+            entry = known.pop(path, None)
+            if entry is not None and entry[:2] == (size, mtime_ns):
+                counts["unchanged"] += 1
+            elif mtime_ns > settled: #Probably still being copied; it is picked up by a later scan
+                counts["waiting"] += 1
+            else:
+                changed[path] = (size, mtime_ns, entry)
+        for path in known: #Whatever is left was not found on disk anymore
+            self.emit({"event": "removed", "path": path})
+            if self.index is not None:
+                self.index.remove(path)
+            self.db.execute("DELETE FROM manifest WHERE path = ?", (path,))
+            counts["removed"] += 1
+        self.db.commit()
+        for path, event in self._read(changed, counts):
+            counts[event] += 1
+        self.db.commit()
+        return counts
+
+    def _read(self, changed: dict, counts: dict):
+        to_read = {}
+        for path, (size, mtime_ns, entry) in changed.items():
+            try:
+                digest = ocr_cache.digest(path) if ocr_cache is not None else file_sha256(path)
+            except OSError:
+                continue #Deleted since the walk; the next scan sees it is gone
+            if entry is not None and entry[2] == digest: #Touched, but the content is the same
+                self._record(path, size, mtime_ns, digest)
+                counts["unchanged"] += 1
+            else:
+                to_read[path] = (size, mtime_ns, digest, "updated" if entry is not None else "added")
+        if self.engine is not None:
+            results = self.engine.scan_files(list(to_read))
+        else:
+            results = self._scan_each(to_read)
+        for path, result, error in results: #Each result goes to the sink as soon as it is ready
+            size, mtime_ns, digest, event = to_read[path]
+            if error is not None:
+                self.emit({"event": "error", "path": path, "error": error})
+                event = "failed"
+            else:
+                self.emit({"event": event, "path": path, "digest": digest, "text": " ".join([text for _, text, _ in result]),
+                           "lines": [{"box": box, "text": text, "confidence": confidence} for box, text, confidence in result]})
+                if self.index is not None:
+                    self.index.update_file(path) #The results come from ocr_cache
+            self._record(path, size, mtime_ns, digest) #A failed file is only tried again once it changes
+            yield path, event
+
+    def _scan_each(self, to_read: dict):
+        for path in to_read:
+            try:
+                yield path, ocr_scan_results(path), None
+            except Exception as error:
+                yield path, None, f"{type(error).__name__}: {error}"
+
+    def _record(self, path: str, size: int, mtime_ns: int, digest: str) -> None:
+        self.db.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)", (path, size, mtime_ns, digest))
+        if time.monotonic() - self.committed > 1.0: #Committing every file would cost more than reading a small one
+            self.db.commit()
+            self.committed = time.monotonic()
+
+    def run(self, interval: float = 5.0, cancel=None) -> None:
+        while not _is_cancelled(cancel):
+            start = time.perf_counter()
+            counts = self.scan()
+            changes = {event: count for event, count in counts.items() if count and event != "unchanged"}
+            if changes:
+                print(f"{time.strftime('%H:%M:%S')} {changes} in {time.perf_counter() - start:.1f} s")
+            if isinstance(cancel, threading.Event):
+                cancel.wait(interval)
+            else:
+                time.sleep(interval)
+
+if __name__ == "__main__" and sys.argv[1:2] == ["watch"]:
+    parser = argparse.ArgumentParser(prog="ocr_and_python.py watch", description="Read new and changed images as they arrive")
+    parser.add_argument("directory")
+    parser.add_argument("--sink", default="ocr_results.jsonl", help="JSONL file the results are appended to")
+    parser.add_argument("--manifest", help="where to keep the list of files that were already read")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between two scans")
+    parser.add_argument("--workers", type=int, default=0, help="read with a pool of this many worker processes")
+    parser.add_argument("--once", action="store_true", help="scan once and exit")
+    options = parser.parse_args(sys.argv[2:])
+    engine = BatchOCREngine(workers=options.workers, ordered=False) if options.workers else None
+    watcher = OCRWatcher(options.directory, options.sink, options.manifest, engine=engine)
+    try:
+        print(watcher.scan()) if options.once else watcher.run(options.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine is None or engine.close()
+    sys.exit()
+
+"""This code adds a *watch mode* for folders where new scans keep arriving. Walking the whole tree with `search_images` and reading every image again to find the new ones takes far too long, so `OCRWatcher` keeps a *manifest* of the files it has already read, and only reads the ones that are new or changed. Here's a breakdown of how it works:
+
+**The Manifest:**
+
+The manifest is an *SQLite* table with the path, size, modification time and content hash of every file that was read. It is stored on disk (in `~/.cache/ocr_and_python/watch_manifest.sqlite3` by default), and every file is recorded right after its result was written and committed at least once a second, so a watcher that is stopped and started again goes on where it left off.
+
+**Fast Rescans:**
+
+`watcher.scan()` walks the directory with `iter_image_stats`, which uses `os.scandir` and gets the size and modification time of every image without opening it. The manifest of the directory is loaded with a single query and compared in memory, so a tree where nothing changed is scanned in seconds, even with millions of files. Only the files whose size or modification time changed are hashed, and only the ones whose content really changed are read with *OCR* (through `ocr_cache`, or through the worker processes of a `BatchOCREngine` when an `engine` is given). Files modified less than `settle` seconds ago may still be being copied, so they are left for the next scan.
+
+**The Sink:**
+
+Every result is given to the `sink` as soon as it is ready. By default this is a `JSONLSink`, which appends one *JSON* line per file to `ocr_results.jsonl` with the `event` (`added` or `updated`), the `path`, the `text` and the `lines` with their box, text and confidence. Deleted files produce a `removed` event and are dropped from the manifest, and files that can't be read produce an `error` event. The sink can also be any function that takes the record. A file could be sent twice if the watcher is stopped before the manifest was committed, but it is never skipped. With an `OCRIndex` as `index`, the index is kept up to date as well.
+
+**Running It:**
+
+`watcher.run(interval=5)` scans again every few seconds until it is interrupted or `cancel` is set. From the command line:
+
+```
+python ocr_and_python.py watch /scans/incoming --sink results.jsonl --workers 8
+```
+"""
+
+# Keep the boxes and confidences of every line: structured results, and a compact columnar store for millions of lines
+
+class OCRLine:
+    __slots__ = ("box", "text", "confidence")
+
+    def __init__(self, box, text: str, confidence: float):
+        self.box = box
+        self.text = text
+        self.confidence = confidence
+
+    def __iter__(self):
+        # Unpacks like the (bbox, text, confidence) tuples of readtext
+        return iter((self.box, self.text, self.confidence))
+
+    def __repr__(self) -> str:
+        return f"OCRLine({self.text!r}, confidence={self.confidence:.2f})"
+
+def line_mask(boxes, confidences, min_confidence: float = 0.0, region: tuple = None):
+    # Vectorized over all the lines: confidence at least min_confidence, and box center inside region (x0, y0, x1, y1)
+    keep = confidences >= min_confidence
+    if region is not None:
+        x0, y0, x1, y1 = region
+        centers = boxes.mean(axis=1)
+        keep &= (centers[:, 0] >= x0) & (centers[:, 0] <= x1) & (centers[:, 1] >= y0) & (centers[:, 1] <= y1)
+    return keep
+
+class OCRResult:
+    __slots__ = ("boxes", "texts", "confidences")
+
+    def __init__(self, boxes, texts: list[str], confidences):
+        import numpy as np
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4, 2) #(lines, 4 corners, x and y)
+        self.texts = list(texts)
+        self.confidences = np.asarray(confidences, dtype=np.float32)
+
+    @classmethod
+    def from_readtext(cls, result: list) -> "OCRResult":
+        return cls([bbox for bbox, _, _ in result], [text for _, text, _ in result], [confidence for _, _, confidence in result])
+
+    def to_readtext(self) -> list:
+        return [(box.tolist(), text, float(confidence)) for box, text, confidence in zip(self.boxes, self.texts, self.confidences)]
+
+    @property
+    def text(self) -> str:
+        return " ".join(self.texts) #The same text ocr_scan returns
+
+    def filter(self, min_confidence: float = 0.0, region: tuple = None) -> "OCRResult":
+        keep = line_mask(self.boxes, self.confidences, min_confidence, region)
+        return OCRResult(self.boxes[keep], [text for text, kept in zip(self.texts, keep) if kept], self.confidences[keep])
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __getitem__(self, i: int) -> OCRLine:
+        return OCRLine(self.boxes[i], self.texts[i], float(self.confidences[i]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self) -> str:
+        return f"OCRResult({len(self)} lines, {self.text[:40]!r})"
+
+def ocr_scan_structured(image_path: str) -> OCRResult:
+    return OCRResult.from_readtext(ocr_scan_results(image_path))
+
+def _read_store_meta(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, "meta.json")) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"lines": 0, "documents": 0, "text_bytes": 0, "documents_bytes": 0}
+
+class OCRStoreWriter:
+    # Appends results to the column files; meta.json says how much of them is complete, and is only written by commit()
+    FILES = ("boxes.f32", "confidences.f32", "text_ends.i64", "text.utf8", "line_ends.i64", "documents.jsonl")
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.meta = _read_store_meta(directory)
+        sizes = [self.meta["lines"] * 32, self.meta["lines"] * 4, self.meta["lines"] * 8, self.meta["text_bytes"],
+                 self.meta["documents"] * 8, self.meta["documents_bytes"]]
+        self.files = {}
+        for name, size in zip(self.FILES, sizes):
+            file = open(os.path.join(directory, name), "ab")
+            file.truncate(size) #Drop whatever a writer that was interrupted wrote after its last commit
+            self.files[name] = file
+
+    def add(self, path: str, result, page: int = 0) -> None:
+        import numpy as np
+        result = result if isinstance(result, OCRResult) else OCRResult.from_readtext(result)
+        encoded = [text.encode("utf-8") for text in result.texts]
+        self.files["boxes.f32"].write(result.boxes.tobytes())
+        self.files["confidences.f32"].write(result.confidences.tobytes())
+        self.files["text_ends.i64"].write((self.meta["text_bytes"] + np.cumsum([len(text) for text in encoded], dtype=np.int64)).tobytes())
+        self.files["text.utf8"].write(b"".join(encoded))
+        self.meta["lines"] += len(result)
+        self.meta["text_bytes"] += sum(len(text) for text in encoded)
+        self.files["line_ends.i64"].write(np.int64(self.meta["lines"]).tobytes())
+        document = (json.dumps([os.path.abspath(path), page]) + "\n").encode()
+        self.files["documents.jsonl"].write(document)
+        self.meta["documents"] += 1
+        self.meta["documents_bytes"] += len(document)
+
+    def commit(self) -> None:
+        for file in self.files.values():
+            file.flush()
+            os.fsync(file.fileno())
+        with open(os.path.join(self.directory, "meta.json.tmp"), "w") as file:
+            json.dump(self.meta, file)
+        os.replace(os.path.join(self.directory, "meta.json.tmp"), os.path.join(self.directory, "meta.json"))
+
+    def close(self) -> None:
+        self.commit()
+        for file in self.files.values():
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+class OCRStore:
+    def __init__(self, directory: str):
+        import numpy as np
+        self.directory = directory
+        meta = _read_store_meta(directory)
+        self.boxes = self._map("boxes.f32", np.float32, (meta["lines"], 4, 2))
+        self.confidences = self._map("confidences.f32", np.float32, (meta["lines"],))
+        self.text_ends = self._map("text_ends.i64", np.int64, (meta["lines"],))
+        self.text = self._map("text.utf8", np.uint8, (meta["text_bytes"],))
+        self.line_ends = self._map("line_ends.i64", np.int64, (meta["documents"],))
+        with open(os.path.join(directory, "documents.jsonl"), "rb") as file:
+            self.documents = [tuple(json.loads(line)) for line in file.read(meta["documents_bytes"]).splitlines()]
+        self.lookup = {document: doc for doc, document in enumerate(self.documents)} #A page added again replaces the old one
+        self.current = None
+        if len(self.lookup) < len(self.documents):
+            self.current = np.zeros(len(self.documents), dtype=bool)
+            self.current[list(self.lookup.values())] = True
+
+    def _map(self, name: str, dtype, shape: tuple):
+        import numpy as np
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype) #An empty file can't be memory-mapped
+        return np.memmap(os.path.join(self.directory, name), dtype=dtype, mode="r", shape=shape)
+
+    def __len__(self) -> int:
+        return len(self.confidences)
+
+    def _line_text(self, i: int) -> str:
+        start = self.text_ends[i - 1] if i else 0
+        return self.text[start:self.text_ends[i]].tobytes().decode("utf-8")
+
+    def _lines_of(self, doc: int) -> range:
+        return range(int(self.line_ends[doc - 1]) if doc else 0, int(self.line_ends[doc]))
+
+    def _result(self, doc: int) -> OCRResult:
+        lines = self._lines_of(doc)
+        return OCRResult(self.boxes[lines.start:lines.stop], [self._line_text(i) for i in lines], self.confidences[lines.start:lines.stop])
+
+    def result(self, path: str, page: int = 0) -> OCRResult:
+        # Only the lines of this page are read from the disk
+        return self._result(self.lookup[(os.path.abspath(path), page)])
+
+    def iter_results(self):
+        # (path, page, result) of every page in the store, one at a time
+        for doc, (path, page) in enumerate(self.documents):
+            if self.current is None or self.current[doc]:
+                yield path, page, self._result(doc)
+
+    def select(self, min_confidence: float = 0.0, region: tuple = None, chunk: int = 1 << 20):
+        # Indexes of all the lines that pass the filters, computed a million lines at a time straight on the mapped columns
+        import numpy as np
+        found = []
+        for start in range(0, len(self), chunk):
+            keep = line_mask(self.boxes[start:start + chunk], self.confidences[start:start + chunk], min_confidence, region)
+            if self.current is not None:
+                keep &= self.current[self.document_of(np.arange(start, start + len(keep)))]
+            found.append(np.flatnonzero(keep) + start)
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+    def document_of(self, lines):
+        import numpy as np
+        return np.searchsorted(self.line_ends, lines, side="right")
+
+    def lines(self, indexes):
+        # (path, page, OCRLine) of the given line indexes, like the ones select returns
+        for i, doc in zip(indexes, self.document_of(indexes)):
+            yield (*self.documents[doc], OCRLine(self.boxes[i], self._line_text(i), float(self.confidences[i])))
+
+def build_ocr_store(store_directory: str, image_directory: str, engine: "BatchOCREngine" = None, commit_every: int = 1000) -> dict:
+    # Reads every image and every page below image_directory (through ocr_cache) into the store
+    counts = {"documents": 0, "failed": 0}
+    with OCRStoreWriter(store_directory) as writer:
+        for source, result, error in scan_page_sources(image_directory, engine):
+            if error is not None:
+                counts["failed"] += 1
+                count_event("failed")
+                continue
+            path, page = source if isinstance(source, tuple) else (source, 0)
+            writer.add(path, result, page)
+            counts["documents"] += 1
+            if counts["documents"] % commit_every == 0:
+                writer.commit()
+
+    return counts
+
+"""This code keeps the full *OCR* results instead of only the joined text. `ocr_scan` returns `" ".join(text)`, which loses the boxes and confidences of the lines, so highlighting a keyword or dropping unsure lines meant reading the image again. Here's a breakdown of how it works:
+
+**Structured Results:**
+
+`ocr_scan_structured(image_path)` returns an `OCRResult`, which keeps the boxes of all the lines in one *numpy* array of shape `(lines, 4, 2)` (the four corners of every box), the confidences in another array, and the texts in a list. `result.text` is the same text `ocr_scan` returns, `result[i]` is an `OCRLine` with the `box`, `text` and `confidence` of one line, and iterating over a result gives the lines in the same `(bbox, text, confidence)` form as `readtext`. `OCRLine` and `OCRResult` use `__slots__`, so they don't carry a dictionary per object.
+
+**Filters:**
+
+`result.filter(min_confidence=0.5, region=(x0, y0, x1, y1))` keeps the lines with at least that confidence whose box center lies inside the region. The check is done with *numpy* on all the boxes at once (`line_mask`).
+
+**The Columnar Store:**
+
+`OCRStoreWriter(directory)` stores results for millions of lines in a directory, one file per column, instead of one object per line:
+
+* `boxes.f32` and `confidences.f32` - the boxes and confidences of all the lines, as raw `float32` arrays,
+* `text.utf8` and `text_ends.i64` - the texts of all the lines one after the other, and where each of them ends,
+* `line_ends.i64` and `documents.jsonl` - where the lines of each page end, and the path and page number of each page,
+* `meta.json` - how many lines, pages and bytes are complete. It is only written by `commit()`, so a writer that is interrupted never leaves a broken store behind, and the next writer cuts off whatever came after the last commit before it appends.
+
+`build_ocr_store(store_directory, image_directory)` reads every image and page of a directory (through `ocr_cache`, or with an `engine`) into a store.
+
+**Reading the Store:**
+
+`OCRStore(directory)` opens the column files as *memory-mapped numpy arrays*, so nothing is read until it is needed. `store.result(path, page)` finds the lines of one page in the `line_ends` array and reads only those. `store.select(min_confidence=0.8, region=(0, 0, 1000, 200))` runs the filters over all the lines of the store with *numpy*, a million lines at a time, and returns the indexes of the matching lines, and `store.lines(indexes)` gives their path, page and `OCRLine`. A page that is added again replaces the old one.
+"""
+
+# Read only the fields of fixed-layout forms, without looking for text on the whole page
+
+import functools
+
+class FormTemplate:
+    def __init__(self, fields: dict[str, tuple], size: tuple = None, anchor: str = None, anchor_box: tuple = None,
+                 search_margin: float = 0.1, padding: int = 4, anchor_distance: int = 1):
+        self.fields = {name: tuple(box) for name, box in fields.items()} #name -> (x0, y0, x1, y1) on the reference form
+        self.size = tuple(size) if size else None #(width, height) of the reference form
+        self.anchor = anchor
+        self.anchor_box = tuple(anchor_box) if anchor_box else None
+        self.search_margin = search_margin
+        self.padding = padding
+        self.anchor_distance = anchor_distance
+
+    @classmethod
+    def from_reference(cls, image_path: str, fields: dict[str, tuple], anchor: str = None, **options) -> "FormTemplate":
+        # Takes the size of the form, and the box of the line with the anchor, from a reference form read with OCR
+        from PIL import Image
+        with Image.open(image_path) as image:
+            size = image.size
+        anchor_box = None
+        if anchor is not None:
+            hits = fuzzy_find(anchor, ocr_scan_results(image_path), options.get("anchor_distance", 1))
+            if not hits:
+                raise ValueError(f"the anchor {anchor!r} was not found on {image_path}")
+            xs, ys = zip(*hits[0][2])
+            anchor_box = (min(xs), min(ys), max(xs), max(ys))
+        return cls(fields, size, anchor, anchor_box, **options)
+
+    @classmethod
+    def load(cls, path: str) -> "FormTemplate":
+        with open(path) as file:
+            return cls(**json.load(file))
+
+    def config(self) -> dict:
+        return {"fields": self.fields, "size": self.size, "anchor": self.anchor, "anchor_box": self.anchor_box,
+                "search_margin": self.search_margin, "padding": self.padding, "anchor_distance": self.anchor_distance}
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as file:
+            json.dump(self.config(), file, indent=2)
+
+def _register_form(reader, grey, template: FormTemplate, scale: float) -> tuple:
+    # (ratio x, ratio y, offset x, offset y, anchor found) taking the reference form onto this image
+    height, width = grey.shape
+    rx = width / scale / template.size[0] if template.size else 1.0
+    ry = height / scale / template.size[1] if template.size else 1.0
+    if template.anchor is None:
+        return rx * scale, ry * scale, 0, 0, None
+    x0, y0, x1, y1 = (round(v) for v in (template.anchor_box[0] * rx * scale, template.anchor_box[1] * ry * scale,
+                                         template.anchor_box[2] * rx * scale, template.anchor_box[3] * ry * scale))
+    margin = round(template.search_margin * max(width, height))
+    left, top = max(0, x0 - margin), max(0, y0 - margin)
+    area = grey[top:min(height, y1 + margin), left:min(width, x1 + margin)]
+    # Only the small area around where the anchor should be goes through the text detector
+    hits = fuzzy_find(template.anchor, read_text(reader, area.copy()), template.anchor_distance)
+    if not hits:
+        return rx * scale, ry * scale, 0, 0, False
+    xs, ys = zip(*hits[0][2])
+    return rx * scale, ry * scale, left + min(xs) - x0, top + min(ys) - y0, True
+
+def read_form_results(reader, image_path: str, template: FormTemplate) -> list:
+    # [(box, text, confidence)] of the fields, in the order of template.fields, with the anchor line first when there is one
+    import numpy as np
+    from PIL import Image
+    if image_loader is not None:
+        grey, scale = image_loader.load(image_path)
+    else:
+        with stage_timer("decode"), Image.open(image_path) as image:
+            grey, scale = np.asarray(image.convert("L")), 1.0
+    height, width = grey.shape
+    rx, ry, dx, dy, found = _register_form(reader, grey, template, scale)
+    boxes = []
+    for x0, y0, x1, y1 in template.fields.values():
+        boxes.append([max(0, round(x0 * rx + dx) - template.padding), min(width, round(x1 * rx + dx) + template.padding),
+                      max(0, round(y0 * ry + dy) - template.padding), min(height, round(y1 * ry + dy) + template.padding)])
+    with stage_timer("recognize"):
+        lines = reader.recognize(grey, horizontal_list=boxes, free_list=[], reformat=False)
+    by_box = {(box[0][0], box[0][1], box[2][0], box[2][1]): (text, confidence) for box, text, confidence in lines}
+    count_event("images")
+    count_event("crops", len(lines))
+    result = [] if found is None else [([[dx, dy]] * 4, template.anchor if found else "", 1.0 if found else 0.0)]
+    for x_min, x_max, y_min, y_max in boxes:
+        text, confidence = by_box.get((x_min, y_min, x_max, y_max), ("", 0.0)) #Empty when the box was too small to read
+        box = [[x_min, y_min], [x_max, y_min], [x_max, y_max], [x_min, y_max]]
+        result.append(ImageLoader.rescale([(box, text, confidence)], scale)[0])
+    return result
+
+def _form_fields(template: FormTemplate, result: list) -> dict:
+    aligned = None
+    if template.anchor is not None:
+        aligned = bool(result[0][1])
+        result = result[1:]
+    fields = {}
+    for name, (box, text, confidence) in zip(template.fields, result):
+        fields[name] = {"text": text, "confidence": float(confidence), "box": box}
+        if aligned is not None:
+            fields[name]["aligned"] = aligned
+    return fields
+
+def _form_key(template: FormTemplate) -> str:
+    return "#form=" + json.dumps(template.config(), sort_keys=True)
+
+def read_form(image_path: str, template: FormTemplate, lang_list: list[str] = ['en']) -> dict:
+    # field -> {"text", "confidence", "box"}, and "aligned" when the template has an anchor
+    if ocr_cache is None:
+        return _form_fields(template, read_form_results(get_reader(lang_list), image_path, template))
+    digest = ocr_cache.digest(image_path)
+    key = ocr_cache.key(digest, reader_fingerprint(lang_list) + _form_key(template))
+    result = ocr_cache.get(key)
+    if result is None:
+        result = read_form_results(get_reader(lang_list), image_path, template)
+        ocr_cache.put(key, digest, result)
+    return _form_fields(template, result)
+
+def read_forms(directory: str, template: FormTemplate, engine: "BatchOCREngine" = None, lang_list: list[str] = ['en']):
+    # Yields (image_path, fields, error) for every image below directory; an engine reads them with its own lang_list
+    if engine is None:
+        for image_path in iter_image_files(directory):
+            try:
+                yield image_path, read_form(image_path, template, lang_list), None
+            except Exception as error:
+                count_event("failed")
+                yield image_path, None, f"{type(error).__name__}: {error}"
+        return
+    task = functools.partial(read_form_results, template=template) #Picklable, so it can be sent to the workers
+    for image_path, result, error in engine.scan(iter_image_files(directory), task, _form_key(template)):
+        yield image_path, _form_fields(template, result) if error is None else None, error
+
+def benchmark_form_reading(image_paths: list[str], template: FormTemplate) -> dict:
+    # Time of the whole page readtext against the template fields only, without the cache
+    reader = get_reader()
+    timings = {}
+    for name, read in [("readtext", lambda image_path: read_image_text(reader, image_path)),
+                       ("template", lambda image_path: read_form_results(reader, image_path, template))]:
+        start = time.perf_counter()
+        for image_path in image_paths:
+            read(image_path)
+        timings[name] = (time.perf_counter() - start) / len(image_paths)
+    print(f"full page: {timings['readtext'] * 1000:.0f} ms per form, template: {timings['template'] * 1000:.0f} ms per form, "
+          f"{timings['readtext'] / timings['template']:.1f}x faster")
+    return timings
+
+"""This code adds a template mode for fixed-layout forms, like invoices or applications that are always printed the same way, where only a few fields are needed. Instead of looking for text on the whole page, which is what takes most of the time in `readtext`, only the regions of the fields are read. Here's a breakdown of how it works:
+
+**Declaring a Template:**
+
+A `FormTemplate` has a name and a box `(x0, y0, x1, y1)` for every field, in the pixels of a reference form, and the `size` of that reference form. Scans at another resolution are scaled to it. A template can be saved to and loaded from a *JSON* file with `template.save(path)` and `FormTemplate.load(path)`.
+
+**Anchor:**
+
+Scans are rarely placed exactly the same on the scanner, so the fields can move a little from one form to the next. The `anchor` is a word printed on every form, like the title "INVOICE". `FormTemplate.from_reference(image_path, fields, anchor="INVOICE")` reads a reference form once to take its size and the box of the anchor. On every form, only a small area around the place where the anchor should be (`search_margin`, a fraction of the page) goes through the text detector. The anchor is looked for with `fuzzy_find`, so it is still found with an *OCR* mistake. The distance between where it was found and where it is on the reference form is then added to all the fields. When it is not found, the fields are read where they are on the reference form, and marked `"aligned": False`.
+
+**Reading Only the Fields:**
+
+The boxes of the fields, with a few pixels of `padding`, are given to `reader.recognize` as its `horizontal_list`. This is the second half of `readtext`, and it skips the text detector completely, so a form with a few fields is typically read many times faster than the whole page. `read_form(image_path, template)` returns a dictionary from every field name to its `text`, `confidence` and `box`. The results are kept in `ocr_cache` with the template as part of the key.
+
+**Many Forms:**
+
+`read_forms(directory, template)` walks a directory like `search_images` does and yields `(image_path, fields, error)` for every image, read with the languages of `lang_list`. Given a `BatchOCREngine` as `engine`, the forms are read by its worker processes (with the engine's `lang_list`): `scan` takes a `task` that the workers run instead of `readtext`, here `read_form_results` with the template, so the forms get the same bounded chunks in flight, the same cache and the same handling of crashed workers as any other scan. A form that makes a worker crash is retried on its own and then reported with an error, and the other forms carry on. `benchmark_form_reading(image_paths, template)` compares the time per form of the template with the time of `readtext` on the whole page.
+"""
+
 def main():
     # Manual input prompts to replace argparse in environments like Jupyter notebooks
     use_directory = input("Do you want to search in a directory (yes/no)? ").lower() == 'yes'
     if use_directory:
         directory = input("Enter the directory path containing the images: ")
         keyword = input("Enter the keyword text you are looking for: ")
-        matching_images = search_images(directory, keyword)
+        index = OCRIndex()
+        index.update(directory) #Only new or changed images are read with OCR
+        matching_images = index.search(keyword_query(keyword), directory)
+        for image_path, error in index.errors.items():
+            print(f"Could not read {image_path}: {error}")
+        if not matching_images: #Maybe the OCR misread the keyword
+            matching_images = FuzzyIndex(index).search(keyword, 1, directory)
         print("Images that contain the keyword:")
         for image_path in matching_images:
             print(image_path)
     else:
         image_path = input("Enter the image path to scan: ")
         keyword = input("Enter the keyword text you are looking for: ")
+        index = OCRIndex()
+        if index.update_file(image_path) == "failed":
+            print(f"Could not read the image: {index.errors[os.path.abspath(image_path)]}")
+            return
         detected_text = ocr_scan(image_path)
-        if keyword.lower() in detected_text.lower():
+        if os.path.abspath(image_path) in index.search(keyword_query(keyword)):
             print("Keyword detected in the image")
             print(f"Detected text: {detected_text}")
+        elif fuzzy_contains(keyword, detected_text):
+            print("Keyword detected in the image, with an OCR mistake")
+            print(f"Detected text: {detected_text}")
         else:
             print("Keyword not detected in the image")
 
@@ -169,15 +2743,18 @@ This part is the main if statement in the `main()` function. If `use_directory`
 
 **Directory Search:**
 
-If the user input “yes” in the user input, it will starts searching in a directory, they are prompted to enter the directory path and the keyword. The function `search_images` is called with the specified directory and keyword and the paths of images containing the keyword will be printed.
+If the user input “yes” in the user input, it will starts searching in a directory, they are prompted to enter the directory path and the keyword. The `OCRIndex` is brought up to date with `index.update(directory)`, which only reads the new or changed images, and then `index.search(keyword, directory)` is queried. The paths of images containing the keyword will be printed. A plain keyword goes through `keyword_query`, so it still matches the start of a word like the original substring search did (`wis` finds `wisdom`), and several words must appear next to each other. The keyword can also use the query syntax of the index, for example `wisdom OR knowledge`. Images that could not be read are listed with the reason. When no image contains the keyword exactly, a `FuzzyIndex` looks for it again with one *OCR* mistake allowed.
 
 **Single Image Analysis:**
 
-If the user chooses to analyse a single image, they are prompted to enter the image path and the keyword. The function `ocr_scan` function is called to extract text from the image. The detected text is compared with the specified keyword, and a message is printed based on the code here:
+If the user chooses to analyse a single image, they are prompted to enter the image path and the keyword. The image is added to the index with `index.update_file(image_path)` (when it can't be read, the reason is printed and the function returns) and the function `ocr_scan` function is called to extract text from the image (its results come from `ocr_cache`, so the image is only read once). The index is queried with the keyword, and a message is printed based on the code here:
 ```
-if keyword.lower() in detected_text.lower():
+if os.path.abspath(image_path) in index.search(keyword_query(keyword)):
 print("Keyword detected in the image")
 print(f"Detected text: {detected_text}")
+elif fuzzy_contains(keyword, detected_text):
+print("Keyword detected in the image, with an OCR mistake")
+print(f"Detected text: {detected_text}")
 else:
 print("Keyword not detected in the image")
 ```
@@ -188,8 +2765,10 @@ def main():
     directory = os.getcwd()  # Gets the current working directory
     keyword = input("Enter the keyword text you are looking for: ")
 
-    # Assuming search_images function is implemented to search through all images in the given directory
-    matching_images = search_images(directory, keyword)
+    # Bring the index up to date with the images in the given directory, then query it
+    index = OCRIndex()
+    index.update(directory)
+    matching_images = index.search(keyword_query(keyword), directory) or FuzzyIndex(index).search(keyword, 1, directory)
 
     if matching_images:
         print("Images that contain the keyword:")
@@ -203,58 +2782,122 @@ def main():
 if __name__ == "__main__":
     main()
 
-"""This other main fuction basically has the same behaviour but instead of asking you for the directory it just searches the images in the default work directory. This is done by saying that the variable `directory` is equal to `os.getcwd()` which refers to the current directory of the program."""
+"""This other main fuction basically has the same behaviour but instead of asking you for the directory it just searches the images in the default work directory. This is done by saying that the variable `directory` is equal to `os.getcwd()` which refers to the current directory of the program. It also searches through the `OCRIndex`, so running it again only reads the images that were added or changed in the meantime, and falls back to a `FuzzyIndex` search when nothing matches exactly."""
+
+# Measure how long it takes to start the program, and how much memory it needs for that
+
+import statistics
+import subprocess
+
+def benchmark_startup(runs: int = 5, module_dir: str = None) -> dict:
+    if module_dir is None:
+        module_dir = os.path.dirname(os.path.abspath(globals().get("__file__", "ocr_and_python.py")))
+    probe = ("import resource, time; start = time.perf_counter(); {statement}; "
+             "print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+    statements = {
+        "python": "pass",
+        "import ocr_and_python": "import ocr_and_python",
+        "import ocr_and_python + get_reader()": "import ocr_and_python; ocr_and_python.get_reader()",
+        "import easyocr + Reader (the old import)": "import easyocr; easyocr.Reader(['en'])",
+    }
+    report = {}
+    for name, statement in statements.items():
+        seconds, rss = [], []
+        for _ in range(runs):
+            # A fresh interpreter for every run, so nothing is already imported
+            output = subprocess.run([sys.executable, "-c", probe.format(statement=statement)], cwd=module_dir,
+                                    capture_output=True, text=True)
+            if output.returncode != 0:
+                break
+            elapsed, max_rss = output.stdout.split()[-2:]
+            seconds.append(float(elapsed))
+            rss.append(int(max_rss) / (1024 * 1024 if sys.platform == "darwin" else 1024)) #ru_maxrss is in bytes on macOS, in KB on Linux
+        if seconds:
+            report[name] = {"seconds": statistics.median(seconds), "peak_rss_mb": max(rss)}
+            print(f"{name:<45} {report[name]['seconds']:8.3f} s {report[name]['peak_rss_mb']:8.1f} MB")
+        else:
+            print(f"{name:<45} failed: {output.stderr.strip().splitlines()[-1] if output.stderr.strip() else output.returncode}")
+
+    return report
+
+"""This code defines `benchmark_startup`, a small benchmark of how long it takes to start using this program and how much memory that needs. Here's a breakdown of how it works:
+
+**A Fresh Interpreter for Every Run:**
+
+Every measurement runs a new Python interpreter with `subprocess.run`, so nothing has been imported yet. Inside it, the time of the statement is taken with `time.perf_counter()` and the peak memory use (*resident set size*, RSS) of the process with `resource.getrusage`.
+
+**What is Measured:**
 
-! pip install nltk matplotlib beautifulsoup4 gensim svgling
+* `python` - an interpreter that does nothing, the lowest possible cost.
+* `import ocr_and_python` - importing this file, which doesn't load *EasyOCR*, *PyTorch* or *NLTK* anymore and doesn't read any image.
+* `import ocr_and_python + get_reader()` - importing this file and creating the reader, which is what the first *OCR* pays.
+* `import easyocr + Reader` - what every import of this file used to pay before the reader was created lazily.
 
-import nltk
-nltk.download('all')
+**Results:**
+
+For every statement, the median time over `runs` runs and the highest peak memory are printed and returned in a dictionary, so they can be compared before and after a change.
+"""
+
+# ! pip install nltk matplotlib beautifulsoup4 gensim svgling
+
+if RUNNING_IN_NOTEBOOK:
+    import nltk
+    nltk.download('all')
 
 #tokenize the data into features (words); display them
-from nltk.tokenize import word_tokenize
-features = word_tokenize(recognized_text)
-print(features)
+if RUNNING_IN_NOTEBOOK:
+    from nltk.tokenize import word_tokenize
+    features = word_tokenize(recognized_text)
+    print(features)
 
 # normalize the features to lower case and exclude punctuation
-features = [feature for feature in features if feature.isalpha()]
-features = [feature.lower() for feature in features]
-print(features)
+if RUNNING_IN_NOTEBOOK:
+    features = [feature for feature in features if feature.isalpha()]
+    features = [feature.lower() for feature in features]
+    print(features)
 
 # create a list of (English) stopwords, and then remove them from the features
-from nltk.corpus import stopwords
-stopwords = stopwords.words('english')
-features = [feature for feature in features if feature not in stopwords]
+if RUNNING_IN_NOTEBOOK:
+    from nltk.corpus import stopwords
+    stopwords = frozenset(stopwords.words('english')) #A set, so every "not in stopwords" is a quick lookup
+    features = [feature for feature in features if feature not in stopwords]
 
 # count & tabulate the features, and then plot the results -- season to taste
-from nltk import FreqDist
-frequencies = FreqDist(features)
-plot = frequencies.plot(10)
+if RUNNING_IN_NOTEBOOK:
+    from nltk import FreqDist
+    frequencies = FreqDist(features)
+    plot = frequencies.plot(10)
 
 # create a list of unique words (hapaxes); display them
-hapaxes = frequencies.hapaxes()
-print(hapaxes)
+if RUNNING_IN_NOTEBOOK:
+    hapaxes = frequencies.hapaxes()
+    print(hapaxes)
 
 # count & tabulate ngrams from the features -- season to taste; display some
-from nltk import ngrams
-ngrams = ngrams(features, 2)
-frequencies = FreqDist(ngrams)
-frequencies.most_common(10)
+if RUNNING_IN_NOTEBOOK:
+    from nltk import ngrams
+    ngrams = ngrams(features, 2)
+    frequencies = FreqDist(ngrams)
+    print(frequencies.most_common(10))
 
 # create a list each token's length, and plot the result; How many "long" words are there?
-lengths = [len(feature) for feature in features]
-plot = FreqDist(lengths).plot(10)
+if RUNNING_IN_NOTEBOOK:
+    lengths = [len(feature) for feature in features]
+    plot = FreqDist(lengths).plot(10)
 
 # initialize a stemmer, stem the features, count & tabulate, and output
-from nltk.stem import PorterStemmer
-stemmer = PorterStemmer()
-stems = [stemmer.stem(feature) for feature in features]
-frequencies = FreqDist(stems)
-frequencies.most_common(10)
+if RUNNING_IN_NOTEBOOK:
+    from nltk.stem import PorterStemmer
+    stemmer = PorterStemmer()
+    stems = [stemmer.stem(feature) for feature in features]
+    frequencies = FreqDist(stems)
+    print(frequencies.most_common(10))
 
 # re-create the features and create a NLTK Text object, so other cool things can be done
-from nltk import Text
-features = word_tokenize(recognized_text)
-text = Text(features)
+if RUNNING_IN_NOTEBOOK:
+    from nltk import Text
+    features = word_tokenize(recognized_text)
+    text = Text(features)
 
 """This code snippet prepares the obtained text from the *OCR* for linguistic analysis using the *Natural Language Toolkit (NLTK)* in Python. Here's a step-by-step explanation:
 
@@ -270,8 +2913,9 @@ This process is crucial for transforming recognized text into a form that is ame
 """
 
 # count & tabulate, again; list a given word -- season to taste
-frequencies = FreqDist(text)
-print(frequencies['it'])
+if RUNNING_IN_NOTEBOOK:
+    frequencies = FreqDist(text)
+    print(frequencies['it'])
 
 """This code snippet continues the process of text analysis by counting and tabulating the frequency of words within a given text, and then specifically listing the frequency of a chosen word, in this case, "it". Here’s a detailed explanation:
 
@@ -287,7 +2931,8 @@ This snippet is a practical example of how text analysis techniques can be appli
 """
 
 # do keyword-in-context searching against the text (concordancing)
-print(text.concordance('it'))
+if RUNNING_IN_NOTEBOOK:
+    print(text.concordance('it'))
 
 """This code snippet is focused on performing a *keyword-in-context (KWIC)* search, also known as concordancing, against a given text using the *Natural Language Toolkit (NLTK)* in Python. Here’s a step-by-step explanation:
 
@@ -303,7 +2948,8 @@ By executing this snippet, users can gain insight into the contexts in which a p
 """
 
 # create a dispersion plot of given words
-plot = text.dispersion_plot(['it', 'a', 'time'])
+if RUNNING_IN_NOTEBOOK:
+    plot = text.dispersion_plot(['it', 'a', 'time'])
 
 """
 This code snippet demonstrates how to create a lexical dispersion plot for a set of specified words within a text using the *Natural Language Toolkit (NLTK)* in Python. Here’s a step-by-step explanation:
@@ -319,7 +2965,8 @@ The assignment of the plot creation method to plot is included in the code snipp
 The dispersion plot is a powerful analytical tool for examining the behavior of words within a text, allowing researchers, students, and enthusiasts to uncover patterns and insights about word usage, thematic elements, and the structure of the textual content."""
 
 # output the "most significant" bigrams, considering surrounding words (size of window) -- season to taste
-text.collocations(num=20, window_size=4)
+if RUNNING_IN_NOTEBOOK:
+    text.collocations(num=20, window_size=4)
 
 """
 This code snippet is aimed at identifying and outputting the "most significant" bigrams within a given text using the *Natural Language Toolkit (NLTK)* in Python, with an adjustable consideration for the context size around each bigram, often referred to as the "window size". Here’s a detailed explanation:
@@ -335,7 +2982,8 @@ The method automatically prints the list of significant bigrams to the console,
 By exploring significant bigrams with adjustable context size, this snippet facilitates a nuanced analysis of the text, enhancing understanding of its linguistic structure, thematic consistencies, or distinctive language patterns."""
 
 # given a set of words, what words are nearby
-text.common_contexts(['wisdom'])
+if RUNNING_IN_NOTEBOOK:
+    text.common_contexts(['wisdom'])
 
 """This code snippet demonstrates how to find and display common contexts for a specified set of words, in this case, a single word "wisdom", within a given text using the *Natural Language Toolkit (NLTK)* in Python. Here's a step-by-step explanation:
 
@@ -351,7 +2999,8 @@ This approach is particularly useful for linguistic and literary analysis, offer
 """
 
 # list the words (features) most associated with the given word
-text.similar('wisdom')
+if RUNNING_IN_NOTEBOOK:
+    text.similar('wisdom')
 
 """This code snippet is designed to find and list words that are most similar to the specified word "wisdom" within a given text, utilizing the *Natural Language Toolkit (NLTK)* in Python. Here’s a detailed explanation:
 
@@ -367,17 +3016,18 @@ This functionality is particularly useful for linguistic analysis, offering insi
 """
 
 # create a list of sentences, and display one -- season to taste
-from nltk import sent_tokenize
-sentences = sent_tokenize(recognized_text)
-index = int(input("Enter the number of the sentence you wish to access: "))
-if index - 1 < len(sentences):
-    sentence = sentences[index - 1]
-    print(sentence)
-else:
-    if len(sentences) == 1:
-        print(f"That number is out of range. The text only has {len(sentences)} sentence.")
+if RUNNING_IN_NOTEBOOK:
+    from nltk import sent_tokenize
+    sentences = sent_tokenize(recognized_text)
+    index = int(input("Enter the number of the sentence you wish to access: "))
+    if index - 1 < len(sentences):
+        sentence = sentences[index - 1]
+        print(sentence)
     else:
-        print(f"That number is out of range. The text only has {len(sentences)} sentences.")
+        if len(sentences) == 1:
+            print(f"That number is out of range. The text only has {len(sentences)} sentence.")
+        else:
+            print(f"That number is out of range. The text only has {len(sentences)} sentences.")
 
 """This code snippet demonstrates how to tokenize a block of text into sentences, then allows a user to select and display a specific sentence by entering its number. Here's a step-by-step explanation:
 
@@ -393,9 +3043,10 @@ This approach enables detailed examination of the text at the sentence level, fa
 """
 
 # tokenize the sentence and parse it into parts-of-speech, all in one go
-from nltk import pos_tag
-sentence = pos_tag(word_tokenize(sentence))
-print(sentence)
+if RUNNING_IN_NOTEBOOK:
+    from nltk import pos_tag
+    sentence = pos_tag(word_tokenize(sentence))
+    print(sentence)
 
 """This code snippet demonstrates how to tokenize a given sentence into individual words and then annotate each token with its corresponding *part-of-speech (POS)* tag, all in one go using the *Natural Language Toolkit (NLTK)* in Python. Here's a detailed explanation:
 
@@ -411,9 +3062,10 @@ This snippet effectively combines the processes of word tokenization and part-of
 """
 
 # extract named enities from a sentence, and print the results
-from nltk import ne_chunk
-entities = ne_chunk(sentence)
-print(entities)
+if RUNNING_IN_NOTEBOOK:
+    from nltk import ne_chunk
+    entities = ne_chunk(sentence)
+    print(entities)
 
 """This code snippet is focused on extracting named entities from a sentence and printing the results using the *Natural Language Toolkit (NLTK)* in Python. Here's a detailed explanation:
 
@@ -429,6 +3081,428 @@ This snippet showcases how NLTK can be used for named entity recognition, a cruc
 """
 
 # output the entites graphically
-entities
+if RUNNING_IN_NOTEBOOK:
+    display(entities)
+
+"""The code snippet you've shared implies the intention to output named entities in a graphical format, specifically referring to the `entities` variable which is expected to hold the result of *named entity recognition (NER) *performed by the ne_chunk function from the *Natural Language Toolkit (NLTK)*."""
+
+# Analyse the text of the whole OCR corpus, not only one recognized_text
+
+import functools
+
+@functools.lru_cache(maxsize=None)
+def english_stopwords() -> frozenset:
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words('english')) #A set, so checking a word is a lookup instead of a scan of the list
+
+@functools.lru_cache(maxsize=None)
+def _porter_stemmer():
+    from nltk.stem import PorterStemmer
+    return PorterStemmer()
+
+@functools.lru_cache(maxsize=1 << 18)
+def stem(word: str) -> str:
+    return _porter_stemmer().stem(word) #Every different word is only stemmed once
+
+def corpus_tokens(text: str) -> list[str]:
+    # Every token of the text in lower case, punctuation included, like the tokens of the Text object above
+    from nltk.tokenize import word_tokenize
+    return [token.lower() for token in word_tokenize(text)]
+
+def is_feature(token: str) -> bool:
+    # The features of the cells above: words only, without stopwords
+    return token.isalpha() and token not in english_stopwords()
+
+def corpus_features(text: str) -> list[str]:
+    return [token for token in corpus_tokens(text) if is_feature(token)]
+
+class CorpusCounts:
+    # Counts that can be added together, so chunks of the corpus can be counted apart and merged
+    def __init__(self, window_size: int = 2):
+        self.window_size = window_size
+        self.documents = 0
+        self.words = collections.Counter() #Every token, stopwords and punctuation too: they are only filtered out by the queries
+        self.bigrams = collections.Counter() #Pairs of tokens at most window_size - 1 tokens apart, as BigramCollocationFinder counts them
+        self.adjacent = collections.Counter() #Pairs of tokens next to each other, only kept apart when window_size > 2
+
+    def add_text(self, text: str) -> None:
+        tokens = corpus_tokens(text)
+        self.documents += 1
+        self.words.update(tokens)
+        for i, first in enumerate(tokens): #Pairs never cross from one document into the next
+            for second in tokens[i + 1:i + self.window_size]:
+                self.bigrams[(first, second)] += 1
+        if self.window_size > 2: #The bigrams also pair tokens further apart, so the neighbours are counted on their own
+            self.adjacent.update(zip(tokens, tokens[1:]))
+
+    def merge(self, other: "CorpusCounts") -> "CorpusCounts":
+        self.documents += other.documents
+        self.words.update(other.words)
+        self.bigrams.update(other.bigrams)
+        self.adjacent.update(other.adjacent)
+        return self
+
+def _count_chunk(texts: list[str], window_size: int) -> CorpusCounts:
+    counts = CorpusCounts(window_size)
+    for text in texts:
+        counts.add_text(text)
+    return counts
+
+class CorpusStats:
+    # The aggregate tables of a corpus in SQLite; counts saved again are added to the ones already there
+    def __init__(self, path: str = os.path.join(os.path.expanduser("~"), ".cache", "ocr_and_python", "corpus_stats.sqlite3")):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.create_function("is_feature", 1, is_feature, deterministic=True) #The filters run when a table is queried
+        self.db.create_function("stem", 1, stem, deterministic=True)
+        self.db.execute("CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS words (word TEXT PRIMARY KEY, count INTEGER)")
+        for table in ("bigrams", "adjacent"):
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (first TEXT, second TEXT, count INTEGER, PRIMARY KEY (first, second))")
+        for table in ("words", "bigrams", "adjacent"):
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_count ON {table} (count)")
+        self.db.commit()
+
+    def total(self, name: str) -> int:
+        row = self.db.execute("SELECT value FROM totals WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def save(self, counts: CorpusCounts) -> None:
+        window_size = self.total("window_size")
+        if window_size and window_size != counts.window_size:
+            raise ValueError(f"{self.path} holds bigrams counted with window_size={window_size}, not {counts.window_size}")
+        add = "ON CONFLICT DO UPDATE SET count = count + excluded.count"
+        self.db.executemany(f"INSERT INTO words VALUES (?, ?) {add}", counts.words.items())
+        self.db.executemany(f"INSERT INTO bigrams VALUES (?, ?, ?) {add}", ((*pair, count) for pair, count in counts.bigrams.items()))
+        self.db.executemany(f"INSERT INTO adjacent VALUES (?, ?, ?) {add}", ((*pair, count) for pair, count in counts.adjacent.items()))
+        self.db.executemany("INSERT INTO totals VALUES (?, ?) ON CONFLICT DO UPDATE SET value = value + excluded.value",
+                            [("documents", counts.documents), ("tokens", sum(counts.words.values()))])
+        self.db.execute("INSERT OR REPLACE INTO totals VALUES ('window_size', ?)", (counts.window_size,))
+        self.db.commit()
+
+    def clear(self) -> None:
+        for table in ("totals", "words", "bigrams", "adjacent"):
+            self.db.execute(f"DELETE FROM {table}")
+        self.db.commit()
+
+    def count(self, word: str) -> int:
+        # Like FreqDist(text)[word], but the tokens were put in lower case, so 'it' also counts 'It'
+        row = self.db.execute("SELECT count FROM words WHERE word = ?", (word.lower(),)).fetchone()
+        return row[0] if row else 0
+
+    def most_common(self, n: int = 10) -> list[tuple[str, int]]:
+        return self.db.execute("SELECT word, count FROM words WHERE is_feature(word) ORDER BY count DESC LIMIT ?", (n,)).fetchall()
+
+    def most_common_bigrams(self, n: int = 10) -> list[tuple[tuple[str, str], int]]:
+        # Pairs of features next to each other in the text; the stopwords between them are not skipped like ngrams(features) does
+        table = "bigrams" if self.total("window_size") <= 2 else "adjacent" #With a wider window, bigrams has pairs further apart
+        return [((first, second), count) for first, second, count in
+                self.db.execute(f"SELECT first, second, count FROM {table} WHERE is_feature(first) AND is_feature(second) "
+                                "ORDER BY count DESC LIMIT ?", (n,))]
+
+    def most_common_stems(self, n: int = 10) -> list[tuple[str, int]]:
+        return self.db.execute("SELECT stem(word), SUM(count) FROM words WHERE is_feature(word) GROUP BY 1 ORDER BY 2 DESC LIMIT ?",
+                               (n,)).fetchall()
+
+    def hapaxes(self, limit: int = 100) -> list[str]:
+        return [word for word, in self.db.execute("SELECT word FROM words WHERE count = 1 AND is_feature(word) LIMIT ?", (limit,))]
+
+    def lengths(self) -> dict:
+        return dict(self.db.execute("SELECT length(word), SUM(count) FROM words WHERE is_feature(word) GROUP BY 1 ORDER BY 1"))
+
+    def collocations(self, num: int = 20, min_count: int = 2) -> list[tuple[str, str]]:
+        # Like text.collocations(): bigrams of all the tokens, filtered and ranked by likelihood ratio as Text.collocation_list does
+        from nltk import FreqDist
+        from nltk.collocations import BigramAssocMeasures, BigramCollocationFinder
+        word_fd = FreqDist(dict(self.db.execute("SELECT word, count FROM words")))
+        bigram_fd = FreqDist({(first, second): count for first, second, count in
+                              self.db.execute("SELECT first, second, count FROM bigrams WHERE count >= ?", (min_count,))})
+        finder = BigramCollocationFinder(word_fd, bigram_fd, window_size=self.total("window_size") or 2)
+        stop = english_stopwords()
+        finder.apply_word_filter(lambda word: len(word) < 3 or word.lower() in stop)
+        return finder.nbest(BigramAssocMeasures.likelihood_ratio, num)
+
+def analyze_corpus(texts, stats: CorpusStats = None, workers: int = None, chunk_documents: int = 256,
+                   flush_documents: int = 100_000, window_size: int = 2) -> CorpusStats:
+    # Counts the texts in chunks on a pool of worker processes, merging the counts and saving them every flush_documents texts
+    stats = stats or CorpusStats()
+    texts = iter(texts)
+    counts = CorpusCounts(window_size)
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        while True:
+            while len(pending) < 2 * workers: #Only a few chunks are in flight, however long the corpus is
+                chunk = list(itertools.islice(texts, chunk_documents))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_count_chunk, chunk, window_size))
+            if not pending:
+                break
+            counts.merge(pending.popleft().result())
+            if counts.documents >= flush_documents:
+                stats.save(counts)
+                counts = CorpusCounts(window_size)
+    stats.save(counts)
+    return stats
+
+def corpus_concordance(store: OCRStore, word: str, width: int = 79, lines: int = 25) -> list[tuple[str, int, str]]:
+    # Keyword in context over the whole store, one page at a time; (path, page, line) like text.concordance prints them
+    from nltk.tokenize import word_tokenize
+    half = (width - len(word) - 2) // 2
+    found = []
+    for path, page, result in store.iter_results():
+        text = result.text
+        if word.lower() not in text.lower(): #Most pages don't have the word, and tokenizing them would cost more
+            continue
+        tokens = word_tokenize(text)
+        for i, token in enumerate(tokens):
+            if token.lower() == word.lower():
+                left = " ".join(tokens[max(0, i - half):i])[-half:]
+                right = " ".join(tokens[i + 1:i + 1 + half])[:half]
+                found.append((path, page, f"{left:>{half}} {token} {right}"))
+                if len(found) >= lines:
+                    return found
+    return found
+
+"""This code runs the same kind of analysis as the cells above over the text of the whole *OCR* corpus, which can be millions of documents, instead of over a single `recognized_text` held in memory. Here's a breakdown of how it works:
+
+**Features:**
+
+`corpus_tokens(text)` splits the text with `word_tokenize` and puts every token in lower case. `is_feature(token)` tells whether a token is one of the features of the cells above: a word that is not a stopword, and `corpus_features(text)` keeps only those. The stopwords are a `frozenset` (`english_stopwords()`), so checking every word is a quick lookup, instead of a comparison with every word of the list that `stopwords.words('english')` returns. `stem(word)` remembers the stems it already computed with `functools.lru_cache`, because the same words come back again and again.
+
+**Counts That Can Be Merged:**
+
+A `CorpusCounts` holds the counts of all the tokens, and of the pairs of tokens (bigrams), for a number of documents. Nothing is filtered out yet: the stopwords and the punctuation are counted too, like `FreqDist(text)` and `text.collocations()` count them above, and the features are only picked when the counts are queried. Counts of different documents can simply be added together with `merge`. Bigrams are counted within a window of `window_size` tokens, in the same way as *NLTK*'s `BigramCollocationFinder` counts them, so they can be used to find collocations later. With a window wider than 2, the bigrams also pair tokens that are a few words apart, so the pairs of tokens next to each other are counted on their own as well (`adjacent`).
+
+**Parallel Chunks:**
+
+`analyze_corpus(texts)` takes the texts one at a time from any iterable, for example from an `OCRStore`:
+
+```
+store = OCRStore("ocr_store")
+stats = analyze_corpus(result.text for _, _, result in store.iter_results())
+```
+
+The texts are sent to a pool of worker processes in chunks of `chunk_documents`, each worker counts its chunk, and the counts are merged as they come back. Only a few chunks are in flight at a time, so the whole corpus is never in memory.
 
-"""The code snippet you've shared implies the intention to output named entities in a graphical format, specifically referring to the `entities` variable which is expected to hold the result of *named entity recognition (NER) *performed by the ne_chunk function from the *Natural Language Toolkit (NLTK)*."""
\ No newline at end of file
+**Aggregate Tables:**
+
+Every `flush_documents` documents, the merged counts are added to the tables of a `CorpusStats` database (`~/.cache/ocr_and_python/corpus_stats.sqlite3` by default), so the counts held in memory stay small. Running `analyze_corpus` again on new documents adds their counts to the ones already stored, and `stats.clear()` starts over.
+
+**Queries:**
+
+`stats.count('it')` counts every token like `FreqDist(text)['it']`, except that the tokens are in lower case, so `It` is counted too. `stats.most_common(10)`, `stats.hapaxes()`, `stats.most_common_stems(10)` and `stats.lengths()` answer the same questions as the cells above about the features; the stopword and punctuation filter (`is_feature`) and the stemmer are registered as *SQLite* functions and applied by the queries. `stats.most_common_bigrams(10)` returns the pairs of features that are next to each other in the text, whatever `window_size` the collocations were counted with; unlike `ngrams(features, 2)`, it doesn't join two features that had a stopword between them. `stats.collocations(20)` builds a `BigramCollocationFinder` from the stored counts of all the tokens, removes the words shorter than three letters and the stopwords, and ranks the bigrams with the likelihood ratio, which is what `text.collocations()` does. `corpus_concordance(store, 'it')` is the keyword in context search of `text.concordance`, which goes through the store one page at a time, skips the pages that don't contain the word at all, and stops after `lines` lines.
+"""
+
+# Generate a synthetic corpus with known text, and benchmark speed and accuracy on it
+
+import math
+import multiprocessing
+import platform
+import random
+
+CORPUS_WORDS = ("ancient wisdom knowledge time history library scroll letter invoice total amount date order number "
+                "customer address river mountain city garden light stone paper window morning evening question answer "
+                "market report summary account balance signature record museum journey village harbour winter summer").split()
+
+def _load_font(font: str, size: int):
+    from PIL import ImageFont
+    return ImageFont.load_default(size) if font is None else ImageFont.truetype(font, size)
+
+def generate_corpus(directory: str, count: int = 100, seed: int = 0, fonts: list[str] = None, sizes: tuple = (9, 12, 16, 24),
+                    rotations: tuple = (0, 0, 1, -2, 5), noise_levels: tuple = (0, 8, 20), dpis: tuple = (150, 300),
+                    blank_ratio: float = 0.0) -> list[dict]:
+    # count images of 4 x 3 inches with random lines of CORPUS_WORDS; the same seed always gives the same images
+    import numpy as np
+    from PIL import Image, ImageDraw
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    truth = []
+    for i in range(count):
+        font, size, rotation = rng.choice(fonts or [None]), rng.choice(sizes), rng.choice(rotations)
+        noise, dpi = rng.choice(noise_levels), rng.choice(dpis)
+        pixels = round(size * dpi / 72) #Font sizes are in points
+        line_font = _load_font(font, pixels)
+        width = 4 * dpi - dpi // 2 #Inside the margins; a word drawn past the edge would still be in the ground truth
+        image = Image.new("L", (4 * dpi, 3 * dpi), 255)
+        draw = ImageDraw.Draw(image)
+        lines = []
+        if rng.random() >= blank_ratio:
+            y, wanted = dpi // 4, rng.randint(2, 8)
+            while len(lines) < wanted and y + pixels < image.height - dpi // 4:
+                words = [rng.choice(CORPUS_WORDS) for _ in range(rng.randint(2, 6))]
+                while len(words) > 1 and line_font.getlength(" ".join(words)) > width:
+                    words.pop()
+                line = " ".join(words)
+                if line_font.getlength(line) > width: #Not even one word fits at this size
+                    break
+                draw.text((dpi // 4, y), line, fill=0, font=line_font)
+                lines.append(line)
+                y += round(pixels * 1.6)
+        if rotation:
+            image = image.rotate(rotation, resample=Image.BICUBIC, expand=True, fillcolor=255)
+        if noise:
+            grain = np.random.default_rng(seed * 1_000_003 + i).normal(0, noise, (image.height, image.width))
+            image = Image.fromarray(np.clip(np.asarray(image) + grain, 0, 255).astype(np.uint8))
+        file = f"synthetic_{i:05d}.{'jpg' if i % 4 == 3 else 'png'}" #Some JPEGs, to also exercise that decoder
+        image.save(os.path.join(directory, file), dpi=(dpi, dpi))
+        truth.append({"file": file, "text": " ".join(lines), "lines": lines, "font": font or "default", "size": size,
+                      "rotation": rotation, "noise": noise, "dpi": dpi})
+    with open(os.path.join(directory, "ground_truth.jsonl"), "w", encoding="utf-8") as file:
+        for record in truth:
+            file.write(json.dumps(record) + "\n")
+    return truth
+
+def load_ground_truth(directory: str) -> list[dict]:
+    with open(os.path.join(directory, "ground_truth.jsonl"), encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+def character_error_rate(reference: str, hypothesis: str) -> float:
+    reference, hypothesis = " ".join(reference.lower().split()), " ".join(hypothesis.lower().split())
+    return edit_distance(reference, hypothesis) / max(1, len(reference))
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    reference, hypothesis = reference.lower().split(), hypothesis.lower().split()
+    return edit_distance(reference, hypothesis) / max(1, len(reference)) #edit_distance works on lists of words too
+
+def _latency_summary(latencies: list[float], elapsed: float, count: int) -> dict:
+    return {"count": count, "seconds": elapsed, "per_second": count / elapsed if elapsed else 0.0,
+            "latency_ms": latency_percentiles([latency * 1000 for latency in latencies])}
+
+def _benchmark_single(directory: str, truth: list[dict]) -> dict:
+    latencies, characters, words = [], [], []
+    start = time.perf_counter()
+    for record in truth:
+        image_start = time.perf_counter()
+        text = ocr_scan(os.path.join(directory, record["file"]))
+        latencies.append(time.perf_counter() - image_start)
+        characters.append((edit_distance(" ".join(record["text"].lower().split()), " ".join(text.lower().split())),
+                           len(record["text"])))
+        words.append((edit_distance(record["text"].lower().split(), text.lower().split()), len(record["text"].split())))
+    report = _latency_summary(latencies, time.perf_counter() - start, len(truth))
+    report["cer"] = sum(errors for errors, _ in characters) / max(1, sum(length for _, length in characters))
+    report["wer"] = sum(errors for errors, _ in words) / max(1, sum(length for _, length in words))
+    return report
+
+def _benchmark_directory(directory: str, truth: list[dict], keyword: str) -> dict:
+    expected = {os.path.join(directory, record["file"]) for record in truth if keyword in record["text"].split()}
+    start = time.perf_counter()
+    found = set(search_images(directory, keyword))
+    elapsed = time.perf_counter() - start
+    report = _latency_summary([], elapsed, len(truth))
+    report["keyword"] = keyword
+    report["recall"] = len(found & expected) / len(expected) if expected else 1.0
+    report["precision"] = len(found & expected) / len(found) if found else 1.0
+    return report
+
+def _benchmark_nlp(truth: list[dict], repeat: int) -> dict:
+    texts = [record["text"] for record in truth] * repeat
+    start = time.perf_counter()
+    counts = _count_chunk(texts, 2) #One process, so the result doesn't depend on the number of cores
+    report = _latency_summary([], time.perf_counter() - start, len(texts))
+    report["tokens"] = sum(counts.words.values())
+    return report
+
+def _benchmark_workload_child(workload: str, corpus_directory: str, truth: list[dict], keyword: str, nlp_repeat: int,
+                              loader: ImageLoader, connection) -> None:
+    global image_loader, ocr_cache
+    image_loader, ocr_cache = loader, None #Every image has to really be read
+    try:
+        if workload in ("single", "directory"):
+            get_reader() #Load the models before anything is timed
+        rss_before = peak_rss_bytes()
+        if workload == "single":
+            report = _benchmark_single(corpus_directory, truth)
+        elif workload == "directory":
+            report = _benchmark_directory(corpus_directory, truth, keyword)
+        elif workload == "nlp":
+            report = _benchmark_nlp(truth, nlp_repeat)
+        else:
+            raise ValueError(f"unknown workload: {workload}")
+        report["peak_rss_bytes"] = peak_rss_bytes()
+        report["peak_rss_growth_bytes"] = report["peak_rss_bytes"] - rss_before
+    except Exception as error: #One workload failing (missing NLTK data...) shouldn't lose the others
+        report = {"error": f"{type(error).__name__}: {error}"}
+    connection.send(report)
+
+def run_benchmarks(corpus_directory: str, output: str = None, workloads: tuple = ("single", "directory", "nlp"),
+                   keyword: str = "wisdom", nlp_repeat: int = 100) -> dict:
+    # Runs every workload on a generated corpus in a fresh process without the cache, and writes the results to a JSON file
+    truth = load_ground_truth(corpus_directory)
+    results = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "corpus": os.path.abspath(corpus_directory), "images": len(truth),
+               "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                               "reader": json.loads(reader_fingerprint())},
+               "workloads": {}}
+    for workload in workloads:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_benchmark_workload_child,
+                                          args=(workload, corpus_directory, truth, keyword, nlp_repeat, image_loader, sender))
+        process.start()
+        sender.close() #So recv() notices when the process dies without sending anything
+        try:
+            report = receiver.recv()
+        except EOFError:
+            report = None
+        process.join()
+        results["workloads"][workload] = report or {"error": f"the benchmark process exited with code {process.exitcode}"}
+    output = output or os.path.join("benchmarks", f"ocr_benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Benchmark results written to {output}")
+
+    return results
+
+BENCHMARK_METRICS = {"per_second": "higher", "cer": "lower", "wer": "lower", "recall": "higher", "peak_rss_bytes": "lower"}
+
+def compare_benchmarks(before: str, after: str, threshold: float = 0.05) -> list[str]:
+    # Compares two result files and returns the metrics that got worse by more than threshold
+    with open(before) as file:
+        old = json.load(file)
+    with open(after) as file:
+        new = json.load(file)
+    worse = []
+    for workload in sorted(set(old["workloads"]) & set(new["workloads"])):
+        old_report, new_report = old["workloads"][workload], new["workloads"][workload]
+        rows = [(name, better, old_report.get(name), new_report.get(name)) for name, better in BENCHMARK_METRICS.items()]
+        rows += [(f"{name} ms", "lower", old_report.get("latency_ms", {}).get(name), new_report.get("latency_ms", {}).get(name))
+                 for name in ("p50", "p95", "p99")]
+        for name, better, old_value, new_value in rows:
+            if old_value is None or new_value is None:
+                continue
+            if old_value:
+                change = (new_value - old_value) / old_value
+            else: #From zero, any change is an infinite one
+                change = 0.0 if new_value == old_value else math.copysign(math.inf, new_value - old_value)
+            got_worse = change < -threshold if better == "higher" else change > threshold
+            print(f"{workload:<10} {name:<16} {old_value:14.4f} -> {new_value:14.4f} {change:+8.1%}{'  WORSE' if got_worse else ''}")
+            if got_worse:
+                worse.append(f"{workload} {name}")
+    return worse
+
+"""This code adds a benchmark suite, to know how fast and how accurate the *OCR* is, and whether a change made it better or worse. Since the results depend on the images, it first generates its own test images, whose text is known. Here's a breakdown of how it works:
+
+**Synthetic Corpus:**
+
+`generate_corpus(directory, count=100, seed=0)` renders `count` images of 4 by 3 inches with a few lines of random words from `CORPUS_WORDS`. For every image, a font, a font size (in points), a rotation, a noise level and a resolution (*DPI*) are chosen at random from the parameters, and some of the images are saved as *JPEG* instead of *PNG*. Everything is random but seeded, so the same seed always produces the same images (with the same version of *Pillow* and the same fonts), without downloading anything. The fonts are paths to *TrueType* files, like `/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf`; by default the font that comes with *Pillow* is used. `blank_ratio` adds images without any text. Every line is measured with the font before it is drawn, and words are dropped from its end until it fits between the margins, so the ground truth never has words that were drawn past the edge of the image. The text of every image, and how it was made, is written to `ground_truth.jsonl`.
+
+**Accuracy:**
+
+`character_error_rate` and `word_error_rate` are the edit distance between the known text and the text the *OCR* found, counted in characters or in words, divided by the length of the known text. A value of 0 means the text was read perfectly.
+
+**Workloads:**
+
+`run_benchmarks(corpus_directory)` turns `ocr_cache` off, so every image is really read, and runs:
+
+* `single` - `ocr_scan` on every image, one after the other, with the images per second, the latency percentiles (*p50*, *p95*, *p99*) and the character and word error rates,
+* `directory` - `search_images` over the whole corpus, with the images per second, and the recall and precision of the keyword against the known text,
+* `nlp` - the corpus analysis (`CorpusCounts`) on the known texts, repeated `nlp_repeat` times, with the documents per second.
+
+Every workload runs in a process of its own, like `benchmark_image_loading` does, so `peak_rss_bytes` is the peak memory of that workload alone (with the models loaded), and not the highest peak of all the workloads run so far. `peak_rss_growth_bytes` is how much the peak grew while the workload ran. A workload that fails (for example when the *NLTK* data is missing) records its error instead of stopping the others.
+
+**Comparing Runs:**
+
+The results are written to a *JSON* file in the `benchmarks` folder, together with the *Python* version, the platform, the number of cores and the reader configuration. `compare_benchmarks(before, after)` prints every metric of two result files next to each other and marks the ones that got worse by more than 5%, for example after upgrading *EasyOCR* or changing the `image_loader`.
+"""
\ No newline at end of file